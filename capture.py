@@ -0,0 +1,186 @@
+import os
+import re
+import hmac
+import gzip
+import json
+import time
+import base64
+import hashlib
+import threading
+
+from urllib.parse import parse_qsl, urlencode
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from starlette.responses import Response
+from starlette.middleware.base import BaseHTTPMiddleware
+
+import config
+
+# Запись входящего трафика для последующего воспроизведения (replay.py). None — запись выключена.
+# Файл — JSONL, при расширении .gz — сжатый gzip.
+CAPTURE_FILE = getattr(config, "CAPTURE_FILE", None)
+CAPTURE_PATHS = tuple(getattr(config, "CAPTURE_PATHS", ("/mts", "/sms", "/call", "/log")))
+
+# Из заголовков в запись попадает только тип содержимого — остальное (IP, прокси, куки) не нужно для replay
+KEEP_HEADERS = ("content-type",)
+# Поля /log, которые идентифицируют человека: в записи заменяются стабильным хэшем
+LOG_PRIVATE_FIELDS = ("user", "ip_address", "proxy")
+# Вебхуки /sms, /call, /mts (query и JSON): номер отправителя/звонящего маскируется, кроме последних
+# 6 цифр (для /call это код). Имена отправителей (Wildberries, OZON.ru) и номер получателя (наш
+# виртуальный номер) остаются открытыми — от них зависят маршрутизация и сопоставление кода.
+WEBHOOK_PATHS = ("/sms", "/call", "/mts")
+WEBHOOK_PHONE_FIELDS = ("contact_phone_number", "sender")
+# Тексты SMS: номера телефонов внутри текста маскируются так же, остальной текст (с кодом) остаётся
+WEBHOOK_TEXT_FIELDS = ("message", "text")
+KEEP_PHONE_DIGITS = 6
+
+# Номер телефона: от 10 цифр, возможно с +, пробелами, скобками и дефисами
+PHONE_RE = re.compile(r"\+?\d[\d\s()-]{8,}\d")
+
+# Соль хэшей /log: своя у каждого процесса записи, не сохраняется. В пределах записи одинаковые
+# значения дают одинаковый хэш, но перебором (например, всех IPv4) значение не восстановить.
+_SALT = os.urandom(16)
+
+_lock = threading.Lock()
+
+
+def _mask(value: str) -> str:
+    return "h:" + hmac.new(_SALT, value.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+
+def mask_phone(value: str) -> str:
+    """Номер телефона без всех цифр, кроме последних KEEP_PHONE_DIGITS; не номер (имя отправителя) — без изменений"""
+
+    digits = re.sub(r"\D", "", value)
+    if len(digits) < 10:
+        return value
+    return "X" * (len(digits) - KEEP_PHONE_DIGITS) + digits[-KEEP_PHONE_DIGITS:]
+
+
+def _sanitize_webhook(data: dict) -> dict:
+    data = dict(data)
+    for field in WEBHOOK_PHONE_FIELDS:
+        if isinstance(data.get(field), str):
+            data[field] = mask_phone(data[field])
+    for field in WEBHOOK_TEXT_FIELDS:
+        if isinstance(data.get(field), str):
+            data[field] = PHONE_RE.sub(lambda m: mask_phone(m.group(0)), data[field])
+    return data
+
+
+def sanitize_query(path: str, query: str) -> str:
+    """Маскирование номеров в query вебхуков (/sms и /call присылают всё в query)"""
+
+    if path not in WEBHOOK_PATHS or not query:
+        return query
+    params = parse_qsl(query, keep_blank_values=True)
+    return urlencode(list(_sanitize_webhook(dict(params)).items()))
+
+
+def sanitize_body(path: str, body: bytes, content_type: str = "") -> bytes | None:
+    """
+    Удаление персональных данных из тела запроса: /log — хэш логина и IP, вебхуки — маскирование номеров.
+
+    Тела вебхуков в JSON и в application/x-www-form-urlencoded маскируются; прочие тела вебхуков
+    (multipart, произвольный текст), поля которых замаскировать нельзя, не записываются — возвращается None.
+    """
+
+    if (path != "/log" and path not in WEBHOOK_PATHS) or not body:
+        return body
+
+    if path in WEBHOOK_PATHS and content_type.startswith("application/x-www-form-urlencoded"):
+        params = parse_qsl(body.decode("utf-8", "ignore"), keep_blank_values=True)
+        return urlencode(list(_sanitize_webhook(dict(params)).items())).encode("utf-8")
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return None if path in WEBHOOK_PATHS else body
+
+    if path == "/log":
+        for field in LOG_PRIVATE_FIELDS:
+            if data.get(field):
+                data[field] = _mask(str(data[field]))
+    else:
+        data = _sanitize_webhook(data)
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+def _encode(body: bytes) -> dict:
+    """Тело в записи: текстом, если это UTF-8, иначе base64"""
+
+    try:
+        return {"text": body.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"b64": base64.b64encode(body).decode("ascii")}
+
+
+def decode_body(record: dict) -> bytes:
+    if "b64" in record:
+        return base64.b64decode(record["b64"])
+    return record.get("text", "").encode("utf-8")
+
+
+def write_record(record: dict) -> None:
+    line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+    opener = gzip.open if CAPTURE_FILE.endswith(".gz") else open
+    with _lock:
+        with opener(CAPTURE_FILE, "at", encoding="utf-8") as file:
+            file.write(line)
+
+
+def read_records(path: str):
+    """Чтение записанного трафика в порядке поступления"""
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+class TrafficRecorderMiddleware(BaseHTTPMiddleware):
+    """Мидлвар записи входящих запросов (с ответом и временем обработки) для replay.py"""
+
+    def __init__(self, app, paths: tuple[str, ...] = CAPTURE_PATHS):
+        super().__init__(app)
+        self.paths = paths
+
+    async def dispatch(self, request: Request, call_next):
+        if not CAPTURE_FILE or request.url.path not in self.paths:
+            return await call_next(request)
+
+        ts = time.time()
+        body = await request.body()
+        started = time.perf_counter()
+        response = await call_next(request)
+
+        # Тело ответа нужно для сравнения при воспроизведении — вычитываем и отдаём клиенту заново
+        chunks = [chunk async for chunk in response.body_iterator]
+        response_body = b"".join(chunks)
+        latency_ms = round((time.perf_counter() - started) * 1000, 3)
+
+        clean_body = sanitize_body(request.url.path, body, request.headers.get("content-type", ""))
+        record = {
+            "ts": ts,
+            "method": request.method,
+            "path": request.url.path,
+            "query": sanitize_query(request.url.path, request.url.query),
+            "headers": {k: v for k, v in request.headers.items() if k in KEEP_HEADERS},
+            "body": _encode(clean_body if clean_body is not None else b""),
+            "body_dropped": clean_body is None,
+            "status": response.status_code,
+            "response": _encode(response_body),
+            "latency_ms": latency_ms,
+        }
+        try:
+            await run_in_threadpool(write_record, record)
+        except OSError as e:
+            print(f"⚠️ Ошибка записи трафика: {e}")
+
+        return Response(content=response_body,
+                        status_code=response.status_code,
+                        headers=dict(response.headers),
+                        media_type=response.media_type)
@@ -6,3 +6,59 @@ DB_URL = f"postgresql+psycopg2://{DB_USER}:{DB_PASS}@{DB_HOST}/{DB_NAME}"
 
 FILE_PATH = "./version/"
 ALLOWED_IPS = []
+
+# --- Необязательные настройки ---
+
+# Токен для служебных эндпоинтов /admin/* (передаётся в заголовке X-Admin-Token)
+ADMIN_API_TOKEN = None
+
+# Трейсинг OTP: JSONL-файл со спанами и/или OTLP/HTTP-коллектор
+TRACE_FILE = None  # например "./traces.jsonl"
+TRACE_OTLP_URL = None  # например "http://127.0.0.1:4318/v1/traces"
+
+# Реплика основной БД для read-only запросов (get_version, get_tg_id, поиск пользователя в /log)
+DB_URL_REPLICA = None  # например f"postgresql+psycopg2://{DB_USER}:{DB_PASS}@<replica_host>/{DB_NAME}"
+REPLICA_MAX_LAG = 5  # секунд: при большем отставании чтения идут в primary
+
+# Запись входящего трафика для replay.py (JSONL, .gz — сжатый). None — запись выключена.
+CAPTURE_FILE = None  # например "./capture.jsonl.gz"
+# Адрес Bot API (для replay указывается заглушка: "http://127.0.0.1:8081")
+TELEGRAM_API_URL = "https://api.telegram.org"
+# Проверка соединения (SELECT 1) при выдаче из пула. Соединение берётся на каждый метод DbConnection,
+# поэтому с проверкой /mts делает лишний запрос к БД на get_tg_id и на add_message. По умолчанию выключена:
+# оборванные соединения ловит retry_on_exception, а старые закрывает pool_recycle.
+DB_POOL_PRE_PING = False
+
+# Таблица маршрутизации номеров (JSON в формате routing.DEFAULT_ROUTING). None — значения по умолчанию.
+# Перечитывается автоматически при изменении файла, по SIGHUP и через POST /admin/routing/reload.
+ROUTING_FILE = None  # например "./routing.json"
+
+# Журнал медленных запросов (ротируемый файл) и выборочный EXPLAIN (ANALYZE, BUFFERS)
+SLOW_QUERY_MS = 200
+SLOW_QUERY_LOG = "./slow_queries.log"  # у каждого воркера свой файл: slow_queries.<pid>.log; None — не писать
+SLOW_QUERY_EXPLAIN_RATE = 0.1
+
+# Прогрев при старте: соединений в каждом пуле БД; срок кэша версии приложения (секунд)
+DB_POOL_WARM = 5
+VERSION_CACHE_TTL = 60
+# Сколько секунд старт ждёт прогрева пулов и версии приложения (прогрев не обязателен)
+DB_WARM_TIMEOUT = 3
+
+# Приём /log: свёртка одинаковых событий за окно (секунд), лимит новых событий (штук, за секунд)
+# на пользователя и на IP, доля сохраняемых событий по типу action. ERROR пишутся всегда.
+LOG_AGGREGATE_WINDOW = 30
+LOG_RATE_LIMIT = (120, 60)
+LOG_SAMPLING = {}  # например {"INFO": 0.2}
+
+# Хеджирование отправки OTP при нескольких TELEGRAM_BOT_TOKEN: вместо копии через каждый бот
+# сообщение уходит через первый, а следующий подключается, если первый не ответил за p95 задержки
+TELEGRAM_HEDGED = False
+HEDGE_MIN_DELAY = 0.3  # секунд
+HEDGE_MAX_DELAY = 3.0
+
+# Конвейер входящих SMS/звонков (запись в БД -> рассылка) с порядком по номеру получателя.
+# True — вебхук отвечает сразу после разбора, обработка идёт в фоне
+PIPELINE_BACKGROUND = False
+PIPELINE_PERSIST_CONCURRENCY = 8  # одновременных записей в БД (не больше пула соединений)
+PIPELINE_NOTIFY_CONCURRENCY = 32  # одновременных рассылок в Telegram
+PIPELINE_DRAIN_TIMEOUT = 30  # секунд на дообработку очереди при остановке
@@ -1,44 +1,172 @@
-from sqlalchemy import create_engine
+import time
+import logging
+import threading
+
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker
 
-from config import DB_URL, DB_URL2
-
-# Один engine на всё приложение
-engine = create_engine(
-    url=DB_URL,
-    echo=False,
-    pool_size=10,
-    max_overflow=5,
-    pool_timeout=30,
-    pool_recycle=600,
-    pool_pre_ping=True,
-    connect_args={
-        "keepalives": 1,
-        "keepalives_idle": 30,
-        "keepalives_interval": 10,
-        "keepalives_count": 5,
-        "connect_timeout": 10,
-    },
-)
+import config
+from database.profiling import instrument, setup_log
+
+logger = logging.getLogger(__name__)
+
+# Необязательная реплика основной БД для read-only запросов
+DB_URL_REPLICA = getattr(config, "DB_URL_REPLICA", None)
+REPLICA_MAX_LAG = getattr(config, "REPLICA_MAX_LAG", 5)  # секунд отставания, после которых читаем с primary
+REPLICA_CHECK_INTERVAL = getattr(config, "REPLICA_CHECK_INTERVAL", 10)  # секунд между проверками реплики
+# Проверка соединения (SELECT 1) при каждой выдаче из пула. Соединения берутся на каждый метод DbConnection,
+# так что проверка добавляла бы запрос к каждому методу. Выключена по умолчанию: обрывы ловит
+# retry_on_exception (откат и повтор), а соединения старше pool_recycle пул закрывает сам.
+DB_POOL_PRE_PING = getattr(config, "DB_POOL_PRE_PING", False)
+
+# Engines создаются при старте приложения (init_engines из lifespan), а не при импорте:
+# импорт модулей не требует доступной БД и полного config
+engine = None
+engine2 = None
+engine_replica = None
+
+# Фабрики сессий; привязываются к engines в init_engines
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+SessionLocal2 = sessionmaker(autocommit=False, autoflush=False)
+SessionReplica = sessionmaker(autocommit=False, autoflush=False)
+
+
+def create_db_engine(url: str, pool_timeout: int = 30, connect_timeout: int = 10):
+    return create_engine(
+        url=url,
+        echo=False,
+        pool_size=10,
+        max_overflow=5,
+        pool_timeout=pool_timeout,
+        pool_recycle=600,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args={
+            "keepalives": 1,
+            "keepalives_idle": 30,
+            "keepalives_interval": 10,
+            "keepalives_count": 5,
+            "connect_timeout": connect_timeout,
+        },
+    )
+
+
+def init_engines() -> None:
+    """Создание engines по config и привязка к ним фабрик сессий. Повторный вызов ничего не делает."""
+
+    global engine, engine2, engine_replica
+
+    if engine is not None:
+        return
+
+    setup_log()
+    engine = create_db_engine(config.DB_URL)
+    instrument(engine, "primary")
+    SessionLocal.configure(bind=engine)
+
+    # Вторая БД (коды WB с прочих MTS-номеров) необязательна
+    db_url2 = getattr(config, "DB_URL2", None)
+    if db_url2:
+        engine2 = create_db_engine(db_url2)
+        instrument(engine2, "secondary")
+        SessionLocal2.configure(bind=engine2)
+    else:
+        print("⚠️ DB_URL2 не задан: WB-коды MTS-номеров без wb_primary не будут сохраняться (add_code)")
+
+    if DB_URL_REPLICA:
+        engine_replica = create_db_engine(DB_URL_REPLICA, pool_timeout=5, connect_timeout=3)
+        instrument(engine_replica, "replica")
+        event.listen(engine_replica, "handle_error", _tag_replica_error)
+        SessionReplica.configure(bind=engine_replica)
+
+
+def _tag_replica_error(context) -> None:
+    """Ошибки реплики помечаются, чтобы retry_on_exception отличал их от ошибок primary"""
+
+    for exc in (context.sqlalchemy_exception, context.original_exception):
+        if exc is not None:
+            try:
+                exc.from_replica = True
+            except AttributeError:
+                pass
+
+
+def is_replica_error(exc: BaseException) -> bool:
+    """True, если ошибка возникла в запросе к реплике (или при подключении к ней)"""
 
-# Фабрика сессий
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
-
-engine2 = create_engine(
-    url=DB_URL2,
-    echo=False,
-    pool_size=10,
-    max_overflow=5,
-    pool_timeout=30,
-    pool_recycle=600,
-    pool_pre_ping=True,
-    connect_args={
-        "keepalives": 1,
-        "keepalives_idle": 30,
-        "keepalives_interval": 10,
-        "keepalives_count": 5,
-        "connect_timeout": 10,
-    },
+    return getattr(exc, "from_replica", False)
+
+
+def secondary_configured() -> bool:
+    """True, если вторая БД (DB_URL2) настроена и SessionLocal2 привязана"""
+
+    return engine2 is not None
+
+
+def warm_pool(db_engine, size: int) -> int:
+    """Открытие `size` соединений заранее: первые запросы после старта не ждут подключения. Возвращает число открытых."""
+
+    connections = []
+    try:
+        for _ in range(size):
+            conn = db_engine.connect()
+            connections.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in connections:
+            conn.close()  # соединение возвращается в пул и остаётся открытым
+    return len(connections)
+
+
+def dispose_engines() -> None:
+    """Закрытие всех соединений пулов при остановке приложения"""
+
+    global engine, engine2, engine_replica
+
+    for db_engine in (engine, engine2, engine_replica):
+        if db_engine is not None:
+            db_engine.dispose()
+    engine = engine2 = engine_replica = None
+
+
+# Состояние реплики: (время проверки, здорова ли). Проверка кэшируется на REPLICA_CHECK_INTERVAL секунд.
+_replica_state = {"checked": 0.0, "healthy": False}
+_replica_lock = threading.Lock()
+
+# Отставание реплики в секундах; 0, если всё полученное WAL уже применено (нет записи на primary)
+REPLICA_LAG_SQL = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
 )
 
-SessionLocal2 = sessionmaker(bind=engine2, autocommit=False, autoflush=False)
+
+def replica_available() -> bool:
+    """True, если реплика настроена, отвечает и отстаёт от primary не больше REPLICA_MAX_LAG секунд."""
+
+    if engine_replica is None:
+        return False
+
+    now = time.monotonic()
+    if now - _replica_state["checked"] < REPLICA_CHECK_INTERVAL:
+        return _replica_state["healthy"]
+
+    with _replica_lock:
+        # Пока ждали блокировку, реплику мог проверить другой поток
+        if now - _replica_state["checked"] < REPLICA_CHECK_INTERVAL:
+            return _replica_state["healthy"]
+        try:
+            with engine_replica.connect() as conn:
+                lag = float(conn.execute(REPLICA_LAG_SQL).scalar() or 0)
+            healthy = lag <= REPLICA_MAX_LAG
+            if not healthy:
+                logger.warning(f"Replica lag {lag:.1f}s > {REPLICA_MAX_LAG}s, reading from primary")
+        except Exception as e:
+            logger.warning(f"Replica check failed: {e}. Reading from primary")
+            healthy = False
+        _replica_state.update(checked=time.monotonic(), healthy=healthy)
+        return healthy
+
+
+def mark_replica_unhealthy() -> None:
+    """Пометить реплику недоступной до следующей плановой проверки (после ошибки запроса)."""
+
+    _replica_state.update(checked=time.monotonic(), healthy=False)
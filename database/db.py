@@ -2,7 +2,7 @@ import time
 import logging
 
 from functools import wraps
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, sessionmaker
 from pyodbc import Error as PyodbcError
 from datetime import datetime, timedelta
 from sqlalchemy.exc import OperationalError
@@ -10,6 +10,8 @@ from sqlalchemy import create_engine, func as f, select, or_
 
 from config import DB_URL
 from database.models import *
+from database.profiling import db_method
+from database.bootstrap import replica_available, mark_replica_unhealthy, is_replica_error
 
 logger = logging.getLogger(__name__)
 
@@ -18,30 +20,47 @@ def retry_on_exception(retries=3, delay=10):
     """
     Декоратор для повторной попытки выполнения метода при ошибках подключения к БД.
 
-    Повторяет вызов до `retries` раз с задержкой `delay` секунд.
+    Повторяет вызов до `retries` раз (или `DbConnection.retries`, если задано) с задержкой `delay` секунд.
     Откатывает сессию при каждой неудачной попытке.
+    Если ошибка пришла из запроса к реплике, повтор сразу идёт на primary без задержки;
+    ошибки primary (в том числе при commit после чтения с реплики) повторяются как обычно.
+    После вызова соединения возвращаются в пул (метод — одна единица работы).
     """
 
     def decorator(func):
         @wraps(func)
         def wrapper(self, *args, **kwargs):
             attempt = 0
-            while attempt < retries:
-                try:
-                    result = func(self, *args, **kwargs)
-                    return result
-                except (OperationalError, PyodbcError) as e:
-                    attempt += 1
-                    logger.debug(f"Error occurred: {e}. Retrying {attempt}/{retries} after {delay} seconds...")
-                    time.sleep(delay)
-                    if hasattr(self, 'session'):
-                        self.session.rollback()
-                except Exception as e:
-                    logger.error(f"An unexpected error occurred: {e}. Rolling back...")
-                    if hasattr(self, 'session'):
-                        self.session.rollback()
-                    raise e
-            raise RuntimeError("Max retries exceeded. Operation failed.")
+            limit = getattr(self, 'retries', None) or retries
+            method_token = db_method.set(func.__name__)
+            try:
+                while attempt < limit:
+                    try:
+                        result = func(self, *args, **kwargs)
+                        return result
+                    except (OperationalError, PyodbcError) as e:
+                        if is_replica_error(e) and getattr(self, 'read_session', None) is not None:
+                            logger.warning(f"Replica error: {e}. Falling back to primary...")
+                            self.drop_replica()
+                            continue
+                        attempt += 1
+                        logger.debug(f"Error occurred: {e}. Retrying {attempt}/{limit} after {delay} seconds...")
+                        if hasattr(self, 'session'):
+                            self.session.rollback()  # до sleep, чтобы не держать соединение во время ожидания
+                        if attempt < limit:
+                            time.sleep(delay)
+                    except Exception as e:
+                        logger.error(f"An unexpected error occurred: {e}. Rolling back...")
+                        if hasattr(self, 'session'):
+                            self.session.rollback()
+                        if getattr(self, 'read_session', None) is not None:
+                            self.read_session.rollback()
+                        raise e
+                raise RuntimeError("Max retries exceeded. Operation failed.")
+            finally:
+                if hasattr(self, 'release'):
+                    self.release()
+                db_method.reset(method_token)
 
         return wrapper
 
@@ -52,16 +71,69 @@ class DbConnection:
     """
     Класс для работы с базой данных через SQLAlchemy.
     Управляет соединением, сессией и предоставляет методы для операций.
+
+    Сессии создаются лениво, при первом обращении из метода, и закрываются после
+    каждого метода: соединение берётся из пула только на время запроса и не удерживается
+    между вызовами (например, пока эндпоинт ждёт Telegram).
+
+    Если передана фабрика реплики, read-only запросы идут в неё (пока реплика здорова),
+    запись (`add_message`, `add_log`, `add_code`) — всегда в `session` (primary).
     """
 
-    def __init__(self, session: Session):
-        self.session = session
+    def __init__(self, session_factory: sessionmaker, read_session_factory: sessionmaker = None,
+                 retries: int = None):
+        self.retries = retries  # число попыток для всех методов; None — по умолчанию retry_on_exception
+        self._session_factory = session_factory
+        self._read_session_factory = read_session_factory
+        self._session = None
+        self._read_session = None
+
+    @property
+    def session(self) -> Session:
+        """Сессия primary; создаётся при первом обращении"""
+
+        if self._session is None:
+            self._session = self._session_factory()
+        return self._session
+
+    @property
+    def read_session(self) -> Session | None:
+        """Открытая сессия реплики, если текущий метод читает из неё"""
+
+        return self._read_session
+
+    @property
+    def reader(self) -> Session:
+        """Сессия для read-only запросов: реплика, если она настроена и не отстаёт, иначе primary"""
+
+        if self._read_session is None and self._read_session_factory is not None and replica_available():
+            self._read_session = self._read_session_factory()
+        return self._read_session if self._read_session is not None else self.session
+
+    def drop_replica(self) -> None:
+        """Отключение реплики после ошибки: дальнейшие чтения этого соединения идут в primary"""
+
+        mark_replica_unhealthy()
+        self._read_session_factory = None
+        try:
+            self._read_session.close()
+        finally:
+            self._read_session = None
+
+    def release(self) -> None:
+        """Закрытие сессий и возврат соединений в пул. Следующий метод откроет новую сессию."""
+
+        for session in (self._session, self._read_session):
+            if session is not None:
+                session.close()
+        self._session = None
+        self._read_session = None
 
     @retry_on_exception()
     def get_version(self) -> str:
         """Получение текущей версии приложения из таблицы `version`"""
 
-        version = self.session.query(Version).first()
+        version = self.reader.query(Version).first()
         return version.version
 
     # Площадка -> колонка-галочка в employees
@@ -105,25 +177,31 @@ class DbConnection:
                     .where(Employee.status == "works", condition)
                     .distinct())
 
-            result = self.session.execute(stmt).all()
+            result = self.reader.execute(stmt).all()
 
             if result:
                 tg_ids = [e.tg_user_id for e in result]
             return tg_ids
+        except (OperationalError, PyodbcError) as e:
+            if is_replica_error(e):
+                raise  # retry_on_exception повторит запрос на primary
+            return None
         except:
             return None
 
     @retry_on_exception()
     def add_message(self, virtual_phone_number: str, time_response: datetime, message: str,
-                    marketplace: str = None) -> None:
+                    marketplace: str = None, attempts: int = 10) -> str | None:
         """
         Добавление кода подтверждения SMS в таблицу phone_message.
 
         Производит поиск по номеру, маркетплейсу и диапазону времени (±2 минуты от time_response),
-        и обновляет соответствующую запись.
+        и обновляет соответствующую запись. Если запрос ещё не создан, поиск повторяется
+        `attempts` раз с паузой 3 секунды (attempts=1 — одна попытка без паузы).
+        Возвращает площадку сопоставленной записи или None, если подходящий запрос не найден.
         """
 
-        for _ in range(10):
+        for attempt in range(attempts):
             if marketplace is None:
                 # Поиск по нескольким маркетплейсам, если не указан явно
                 mes = self.session.query(PhoneMessage).filter(
@@ -149,9 +227,14 @@ class DbConnection:
                 # Обновление найденной записи
                 mes.time_response = time_response
                 mes.message = message
+                matched = mes.marketplace  # до commit: после него атрибуты экспирятся и потребуют лишний SELECT
                 self.session.commit()
-                break
-            time.sleep(3)
+                return matched
+            # Завершаем транзакцию до паузы: соединение возвращается в пул, а не простаивает 3 секунды
+            self.session.rollback()
+            if attempt + 1 < attempts:
+                time.sleep(3)
+        return None
 
     @retry_on_exception()
     def add_log(self,
@@ -173,7 +256,7 @@ class DbConnection:
         user_name = None
         if user:
             # Приведение логина к регистронезависимому виду
-            user_bd = self.session.query(User).filter(f.lower(User.user) == user.lower()).first()
+            user_bd = self.reader.query(User).filter(f.lower(User.user) == user.lower()).first()
             if user_bd:
                 user_name = user_bd.user
 
@@ -192,6 +275,35 @@ class DbConnection:
         self.session.add(log)
         self.session.commit()
 
+    @retry_on_exception()
+    def add_logs(self, rows: list[dict]) -> None:
+        """
+        Пакетная запись свёрнутых событий (`log`) одной транзакцией.
+
+        Каждая строка — поля LogEntry плюс repeat_count и last_timestamp.
+        Логины проверяются одним запросом, как в `add_log`.
+        """
+        logins = {row["user"].lower() for row in rows if row.get("user")}
+        users = {}
+        if logins:
+            for (user,) in self.reader.query(User.user).filter(f.lower(User.user).in_(logins)):
+                users[user.lower()] = user
+
+        self.session.add_all(Log(
+            timestamp=row["timestamp"],
+            timestamp_user=row.get("timestamp_user"),
+            action=row["action"],
+            user=users.get(row["user"].lower()) if row.get("user") else None,
+            ip_address=row["ip_address"],
+            city=row["city"],
+            country=row["country"],
+            proxy=row.get("proxy"),
+            description=row.get("description") or '',
+            repeat_count=row.get("repeat_count", 1),
+            last_timestamp=row.get("last_timestamp"),
+        ) for row in rows)
+        self.session.commit()
+
     @retry_on_exception()
     def add_code(self, virtual_phone_number: str, time_response: datetime, code: str) -> None:
         """
@@ -61,6 +61,8 @@ class Log(Base):
     - country: определённая по IP страна
     - proxy: использованный прокси (если есть)
     - description: текстовое описание события или ошибки
+    - repeat_count: сколько одинаковых событий свёрнуто в эту запись
+    - last_timestamp: серверное время последнего повтора (timestamp — первого), если повторы были
     """
     __tablename__ = 'log'
 
@@ -74,6 +76,8 @@ class Log(Base):
     country = Column(String(length=255), nullable=False)
     proxy = Column(String(length=255), nullable=True)
     description = Column(Text, nullable=False)
+    repeat_count = Column(Integer, default=1, server_default='1', nullable=False)
+    last_timestamp = Column(DateTime, default=None, nullable=True)
 
 
 class Version(Base):
@@ -0,0 +1,168 @@
+import os
+import re
+import time
+import random
+import logging
+import threading
+
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import config
+
+# Запросы дольше порога (мс) пишутся в журнал медленных запросов
+SLOW_QUERY_MS = getattr(config, "SLOW_QUERY_MS", 200)
+# Ротируемый файл журнала; None — журнал не пишется, статистика для /admin/slow_queries собирается всё равно.
+# Каждый процесс (воркер uvicorn) пишет и ротирует свой файл: к имени добавляется PID (slow_queries.<pid>.log).
+SLOW_QUERY_LOG = getattr(config, "SLOW_QUERY_LOG", "./slow_queries.log")
+# Доля медленных SELECT, для которых снимается EXPLAIN (ANALYZE, BUFFERS) (запрос выполняется повторно)
+SLOW_QUERY_EXPLAIN_RATE = getattr(config, "SLOW_QUERY_EXPLAIN_RATE", 0.1)
+# Не чаще одного плана на запрос за столько секунд
+SLOW_QUERY_EXPLAIN_INTERVAL = 60
+
+# Метод DbConnection, внутри которого выполняется запрос (ставит retry_on_exception)
+db_method: ContextVar[str] = ContextVar("db_method", default="-")
+
+logger = logging.getLogger("slow_queries")
+logger.propagate = False
+_handler: RotatingFileHandler | None = None
+
+
+def setup_log() -> None:
+    """
+    Открытие журнала медленных запросов текущего процесса (из init_engines, при старте приложения).
+    При импорте файл не создаётся, поэтому скрипты, импортирующие database, журнал не трогают.
+    """
+
+    global _handler
+    if not SLOW_QUERY_LOG or _handler is not None:
+        return
+    root, ext = os.path.splitext(SLOW_QUERY_LOG)
+    _handler = RotatingFileHandler(f"{root}.{os.getpid()}{ext}", maxBytes=10 * 1024 * 1024, backupCount=5,
+                                   encoding="utf-8")
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+
+_PARAM_RE = re.compile(r"%\(\w+\)s|%s|\?")
+_IN_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE_RE = re.compile(r"\s+")
+
+_stats_lock = threading.Lock()
+_stats: dict[tuple[str, str, str], dict] = {}
+_last_explain: dict[str, float] = {}
+
+
+def normalize(statement: str) -> str:
+    """Запрос без значений: параметры -> ?, списки IN (?, ?, ...) -> (...), пробелы схлопнуты"""
+
+    statement = _PARAM_RE.sub("?", statement)
+    statement = _IN_LIST_RE.sub("(...)", statement)
+    return _SPACE_RE.sub(" ", statement).strip()
+
+
+def params_shape(parameters) -> dict | list | str:
+    """Форма параметров без значений: имя -> тип"""
+
+    if isinstance(parameters, dict):
+        return {k: type(v).__name__ for k, v in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(v).__name__ for v in parameters]
+    return type(parameters).__name__
+
+
+def _explain(conn, statement: str, parameters) -> str:
+    """План запроса в той же транзакции. Savepoint — чтобы ошибка EXPLAIN не сломала транзакцию метода."""
+
+    cursor = conn.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            raise
+        cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        return plan
+    finally:
+        cursor.close()
+
+
+def _want_explain(conn, statement: str, key: str) -> bool:
+    if conn.dialect.name != "postgresql" or not statement.lstrip().upper().startswith("SELECT"):
+        return False
+    if random.random() >= SLOW_QUERY_EXPLAIN_RATE:
+        return False
+    now = time.monotonic()
+    with _stats_lock:
+        if now - _last_explain.get(key, -SLOW_QUERY_EXPLAIN_INTERVAL) < SLOW_QUERY_EXPLAIN_INTERVAL:
+            return False
+        _last_explain[key] = now
+    return True
+
+
+def instrument(engine: Engine, name: str) -> None:
+    """Замер времени каждого запроса engine с привязкой к методу DbConnection"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed_ms = (time.perf_counter() - conn.info["query_start"].pop()) * 1000
+        method = db_method.get()
+        normalized = normalize(statement)
+        slow = elapsed_ms >= SLOW_QUERY_MS
+
+        with _stats_lock:
+            stats = _stats.setdefault((name, method, normalized),
+                                      {"count": 0, "slow": 0, "total_ms": 0.0, "max_ms": 0.0})
+            stats["count"] += 1
+            stats["slow"] += slow
+            stats["total_ms"] += elapsed_ms
+            stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+
+        if not slow:
+            return
+
+        plan = None
+        if not executemany and _want_explain(conn, statement, normalized):
+            try:
+                plan = _explain(conn, statement, parameters)
+            except Exception as e:
+                plan = f"EXPLAIN failed: {e}"
+
+        logger.info(f"[{name}] {method} {elapsed_ms:.1f} ms\n"
+                    f"  statement: {normalized}\n"
+                    f"  params: {params_shape(parameters)}"
+                    + (f"\n  plan:\n    " + plan.replace("\n", "\n    ") if plan else ""))
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # Упавший запрос не доходит до after_cursor_execute — убираем его отметку времени
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
+
+def top_queries(limit: int = 20) -> list[dict]:
+    """Самые дорогие запросы по суммарному времени"""
+
+    with _stats_lock:
+        items = [(key, dict(stats)) for key, stats in _stats.items()]
+    items.sort(key=lambda item: item[1]["total_ms"], reverse=True)
+    return [{
+        "engine": name,
+        "method": method,
+        "statement": statement,
+        "count": stats["count"],
+        "slow": stats["slow"],
+        "total_ms": round(stats["total_ms"], 1),
+        "avg_ms": round(stats["total_ms"] / stats["count"], 2),
+        "max_ms": round(stats["max_ms"], 1),
+    } for (name, method, statement), stats in items[:limit]]
@@ -0,0 +1,107 @@
+import time
+import asyncio
+
+from collections import deque
+
+import config
+
+# Хеджирование отправки в Telegram: если бот не ответил за p95 обычной задержки,
+# то же сообщение параллельно уходит через следующий бот; доставленный дубль удаляется
+TELEGRAM_HEDGED = getattr(config, "TELEGRAM_HEDGED", False)
+# Границы задержки перед запасной отправкой (секунд) и значение, пока статистики мало
+HEDGE_MIN_DELAY = getattr(config, "HEDGE_MIN_DELAY", 0.3)
+HEDGE_MAX_DELAY = getattr(config, "HEDGE_MAX_DELAY", 3.0)
+HEDGE_DEFAULT_DELAY = getattr(config, "HEDGE_DEFAULT_DELAY", 1.0)
+HEDGE_MIN_SAMPLES = 20
+
+
+class LatencyTracker:
+    """Скользящая статистика времени успешных отправок для адаптивной задержки хеджирования"""
+
+    def __init__(self, size: int = 200):
+        self.samples: deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def p95(self) -> float | None:
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        values = sorted(self.samples)
+        return values[int(0.95 * (len(values) - 1))]
+
+    def delay(self) -> float:
+        p95 = self.p95()
+        if p95 is None:
+            return HEDGE_DEFAULT_DELAY
+        return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, p95))
+
+
+latency = LatencyTracker()
+_background: set[asyncio.Task] = set()
+
+
+async def _timed(send, token: str):
+    started = time.perf_counter()
+    result = await send(token)
+    if result is not None:
+        latency.add(time.perf_counter() - started)
+    return result
+
+
+def _suppress(task: asyncio.Task, token: str, on_duplicate) -> None:
+    """Проигравшая отправка дорабатывает в фоне; если она всё же доставила сообщение — дубль удаляется"""
+
+    async def wait_and_delete():
+        try:
+            result = await task
+        except Exception:
+            return
+        if result is not None:
+            await on_duplicate(token, result)
+
+    if task.done() and (task.cancelled() or task.exception() is not None or task.result() is None):
+        return
+    cleanup = asyncio.create_task(wait_and_delete())
+    _background.add(cleanup)
+    cleanup.add_done_callback(_background.discard)
+
+
+async def hedged_send(tokens: list[str], send, on_duplicate):
+    """
+    Отправка одного сообщения с хеджированием по ботам.
+
+    send(token) -> результат при успехе или None; on_duplicate(token, result) удаляет лишнюю копию.
+    Сначала отправляет первый бот; если он не успел за адаптивную задержку (p95) или
+    не смог отправить, запускается следующий. Возвращает первый успешный результат или None.
+    """
+
+    pending: dict[asyncio.Task, str] = {}
+    remaining = list(tokens)
+    winner = None
+
+    try:
+        while remaining or pending:
+            if remaining:
+                token = remaining.pop(0)
+                pending[asyncio.create_task(_timed(send, token))] = token
+            timeout = latency.delay() if remaining else None
+
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                token = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    print(f"⚠️ Ошибка отправки в Telegram: {e}")
+                    continue
+                if result is not None and winner is None:
+                    winner = result
+                elif result is not None:
+                    await on_duplicate(token, result)
+            if winner is not None:
+                return winner
+    finally:
+        for task, token in pending.items():
+            _suppress(task, token, on_duplicate)
+    return None
@@ -0,0 +1,179 @@
+import time
+import random
+import asyncio
+
+from datetime import datetime, timedelta, timezone
+
+from fastapi.concurrency import run_in_threadpool
+
+import config
+
+# Одинаковые события в пределах окна (секунд) сворачиваются в одну строку log с repeat_count
+LOG_AGGREGATE_WINDOW = getattr(config, "LOG_AGGREGATE_WINDOW", 30)
+# Больше групп в памяти — сбрасываем в БД досрочно
+LOG_MAX_PENDING = getattr(config, "LOG_MAX_PENDING", 10_000)
+# Лимит новых (неповторяющихся) событий: (событий, за секунд) отдельно на пользователя и на IP
+LOG_RATE_LIMIT = getattr(config, "LOG_RATE_LIMIT", (120, 60))
+# Доля сохраняемых новых событий по типу action, например {"INFO": 0.2}. Не указан — сохраняются все.
+LOG_SAMPLING = getattr(config, "LOG_SAMPLING", {})
+# Эти типы пишутся сразу и всегда: без лимитов, выборки и свёртки
+LOG_ALWAYS_KEEP = tuple(a.upper() for a in getattr(config, "LOG_ALWAYS_KEEP", ("ERROR", "CRITICAL")))
+
+# Поля, по которым события считаются одинаковыми
+GROUP_FIELDS = ("user", "ip_address", "action", "description", "proxy", "city", "country")
+
+# Серверное время событий хранится без часового пояса, по Москве (как время уведомлений в main)
+MSK = timezone(timedelta(hours=3))
+
+SAVED = "saved"
+AGGREGATED = "aggregated"
+THROTTLED = "throttled"
+SAMPLED_OUT = "sampled_out"
+
+
+class TokenBucket:
+    """Лимитер «маркерная корзина» по ключам: `capacity` событий, пополнение capacity/period в секунду"""
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.buckets: dict[str, tuple[float, float]] = {}  # ключ -> (маркеров, время обновления)
+
+    def _tokens(self, key: str, now: float) -> float:
+        tokens, updated = self.buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def allow(self, keys: list[str]) -> bool:
+        """Маркер списывается со всех корзин сразу, только если он есть в каждой"""
+
+        now = time.monotonic()
+        tokens = {key: self._tokens(key, now) for key in keys}
+        if any(t < 1 for t in tokens.values()):
+            return False
+        for key, t in tokens.items():
+            self.buckets[key] = (t - 1, now)
+        return True
+
+    def cleanup(self) -> None:
+        """Удаление полностью восстановившихся корзин, чтобы словарь не разрастался"""
+
+        now = time.monotonic()
+        for key in [k for k in self.buckets if self._tokens(k, now) >= self.capacity]:
+            del self.buckets[key]
+
+
+def normalize_timestamps(entry: dict) -> dict:
+    """
+    Приведение времени события к одному виду — naive: клиенты присылают время и с поясом, и без.
+    timestamp с поясом переводится в московское время; у timestamp_user (локальное время пользователя)
+    пояс просто отбрасывается.
+    """
+
+    timestamp = entry.get("timestamp")
+    if isinstance(timestamp, datetime) and timestamp.tzinfo is not None:
+        entry["timestamp"] = timestamp.astimezone(MSK).replace(tzinfo=None)
+    timestamp_user = entry.get("timestamp_user")
+    if isinstance(timestamp_user, datetime) and timestamp_user.tzinfo is not None:
+        entry["timestamp_user"] = timestamp_user.replace(tzinfo=None)
+    return entry
+
+
+class LogIngest:
+    """
+    Приём событий /log: сворачивание повторов, лимиты и выборка.
+
+    Повтор события, уже ожидающего записи, только увеличивает счётчик. Лимиты и выборка
+    применяются к новым событиям, поэтому объём записи зависит от числа разных событий,
+    а не от того, как часто клиент их шлёт. Вызывается только из event loop.
+    """
+
+    def __init__(self, window: float = LOG_AGGREGATE_WINDOW, max_pending: int = LOG_MAX_PENDING,
+                 rate_limit: tuple[int, float] = LOG_RATE_LIMIT, sampling: dict = None):
+        self.window = window
+        self.max_pending = max_pending
+        self.limiter = TokenBucket(*rate_limit)
+        self.sampling = {k.upper(): v for k, v in (LOG_SAMPLING if sampling is None else sampling).items()}
+        self.pending: dict[tuple, dict] = {}
+        self.dropped = {THROTTLED: 0, SAMPLED_OUT: 0}
+        self._task: asyncio.Task | None = None
+        self._writer = None
+
+    @staticmethod
+    def always_keep(entry: dict) -> bool:
+        return (entry.get("action") or "").upper() in LOG_ALWAYS_KEEP
+
+    def ingest(self, entry: dict, client_ip: str) -> str:
+        """Учёт события (кроме always_keep). Возвращает, что с ним произошло."""
+
+        normalize_timestamps(entry)
+        key = tuple(entry.get(f) for f in GROUP_FIELDS)
+        group = self.pending.get(key)
+        if group is not None:
+            group["repeat_count"] += 1
+            group["last_timestamp"] = max(group["last_timestamp"], entry["timestamp"])
+            return AGGREGATED
+
+        keys = [f"ip:{client_ip}"] + ([f"user:{entry['user'].lower()}"] if entry.get("user") else [])
+        if not self.limiter.allow(keys):
+            self.dropped[THROTTLED] += 1
+            return THROTTLED
+
+        rate = self.sampling.get((entry.get("action") or "").upper(), 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            self.dropped[SAMPLED_OUT] += 1
+            return SAMPLED_OUT
+
+        self.pending[key] = {**entry, "repeat_count": 1, "last_timestamp": entry["timestamp"],
+                             "_first_seen": time.monotonic()}
+        return SAVED
+
+    def take_due(self, force: bool = False) -> list[dict]:
+        """Группы, окно которых закрылось (или все при force/переполнении), для записи в БД"""
+
+        now = time.monotonic()
+        overflow = len(self.pending) > self.max_pending
+        due = [k for k, g in self.pending.items() if force or overflow or now - g["_first_seen"] >= self.window]
+        rows = []
+        for key in due:
+            group = self.pending.pop(key)
+            group.pop("_first_seen")
+            if group["repeat_count"] == 1:
+                group["last_timestamp"] = None
+            rows.append(group)
+        return rows
+
+    async def flush(self, force: bool = False) -> None:
+        rows = self.take_due(force)
+        if rows:
+            try:
+                await run_in_threadpool(self._writer, rows)
+            except Exception as e:
+                print(f"⚠️ Ошибка записи логов ({len(rows)} строк): {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(1)
+            await self.flush()
+            self.limiter.cleanup()
+
+    def start(self, writer) -> None:
+        """Запуск фоновой записи; writer(rows) вызывается в пуле потоков"""
+
+        self._writer = writer
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановка с записью всего накопленного"""
+
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._writer is not None:
+            await self.flush(force=True)
+
+
+log_ingest = LogIngest()
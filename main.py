@@ -5,21 +5,40 @@ import httpx
 import asyncio
 
 from pydantic import BaseModel
+from dataclasses import dataclass
 from urllib.parse import unquote
 from fastapi.middleware import Middleware
+from contextlib import asynccontextmanager
 from fastapi.concurrency import run_in_threadpool
 from datetime import datetime, timedelta, timezone
 from starlette.middleware.base import BaseHTTPMiddleware
 from fastapi import FastAPI, Request, Depends, HTTPException
 from starlette.responses import StreamingResponse, JSONResponse
 
+import config
+import routing
+import tracing
+from routing import Route, DEFAULT_ROUTE
+from resources import resources, DB_WARM_TIMEOUT
+from hedging import TELEGRAM_HEDGED, hedged_send
+from pipeline import KeyedPipeline, PIPELINE_BACKGROUND, PIPELINE_PERSIST_CONCURRENCY, PIPELINE_NOTIFY_CONCURRENCY
+from log_ingest import log_ingest, normalize_timestamps, SAVED, AGGREGATED
+from capture import TrafficRecorderMiddleware
+from tracing import Trace, report as trace_report
+from database.profiling import top_queries
 from database.db import DbConnection
 from pydantic_models import LogEntry
-from database.bootstrap import SessionLocal, SessionLocal2
-from config import ALLOWED_IPS, FILE_PATH, TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, ADMIN_TG_ID, PROXY, NOVOFON_BOT_TOKEN, \
+from database.bootstrap import SessionLocal, SessionLocal2, SessionReplica, secondary_configured
+from config import ALLOWED_IPS, FILE_PATH, TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, ADMIN_TG_ID, NOVOFON_BOT_TOKEN, \
     NOVOFON_CHAT_ID
 
+# Токен для служебных эндпоинтов /admin/* (заголовок X-Admin-Token). Не задан — эндпоинты закрыты.
+ADMIN_API_TOKEN = getattr(config, "ADMIN_API_TOKEN", None)
+# Адрес Bot API. Для replay.py указывается заглушка, чтобы не слать сообщения в настоящий Telegram.
+TELEGRAM_API_URL = getattr(config, "TELEGRAM_API_URL", "https://api.telegram.org")
+
 MDV2_SPECIALS = r'[_\[\]()~`>#+\|{}]'
+MDV2_RE = re.compile(MDV2_SPECIALS)
 
 
 class MTSMessage(BaseModel):
@@ -47,14 +66,6 @@ def is_duplicate_message(msg: MTSMessage) -> bool:
     return last is not None and now - last <= DEDUP_WINDOW
 
 
-# Novofon-номера (10 цифр), звонки/SMS которых дополнительно дублируются в бота
-# (адресно по привязке get_tg_id). Novofon-чат при этом получает копию как обычно.
-NOVOFON_TO_BOT = {
-    '9240778433', '9333994170', '9952226756', '9843332141',
-    '9699992486', '9699997468', '9581110845', '9333994184',
-    '9240778126', '9240779171', '9581119477', '9860889534',
-}
-
 # Определение площадки по ключевым словам (для фильтра по галочкам)
 MARKETPLACE_KEYWORDS = {
     'WB': ['wildberries', 'wb', 'вайлдберриз', 'вб'],
@@ -73,45 +84,82 @@ def detect_marketplace(sender: str = '', text: str = '') -> str | None:
     return None
 
 
+# Шаблоны кода в тексте сообщения: (регулярка, преобразование найденного), в порядке приоритета
+SMS_CODE_PATTERNS = (
+    (re.compile(r'\b\d{6}\b'), lambda s: s),
+    (re.compile(r'\b\d{3}-\d{3}\b'), lambda s: s.replace('-', '')),
+    (re.compile(r'\b\d{4}\b'), lambda s: s),
+)
+# В SMS от WB на MTS-номера код всегда 6-значный (возможно, через дефис)
+MTS_CODE_PATTERNS = SMS_CODE_PATTERNS[:2]
+
+
+def extract_code(text: str, patterns=SMS_CODE_PATTERNS) -> str | None:
+    """Первый найденный код по шаблонам в порядке приоритета. None — кода в тексте нет."""
+    for pattern, transform in patterns:
+        match = pattern.search(text)
+        if match:
+            return transform(match.group(0))
+    return None
+
+
 def escape_mdv2(text: str) -> str:
-    return re.sub(MDV2_SPECIALS, lambda m: '\\' + m.group(0), text)
+    return MDV2_RE.sub(lambda m: '\\' + m.group(0), text)
 
 
-async def request_telegram2(mes: str):
-    mes2 = escape_mdv2(mes)
-    api = f"https://api.telegram.org/bot{NOVOFON_BOT_TOKEN}/sendMessage"
+async def send_telegram(token: str, chat_id: str, mes: str, mes2: str) -> httpx.Response | None:
+    """
+    Отправка одного сообщения через бота `token`: сначала с разметкой (`mes2`),
+    при неудаче — простым текстом (`mes`). Возвращает ответ Telegram или None при сетевой ошибке.
+    """
 
-    timeout = httpx.Timeout(10.0, connect=5.0)
+    api = f"{TELEGRAM_API_URL}/bot{token}/sendMessage"
+    client = resources.telegram
+
+    for _ in range(1):
+        try:
+            r = await client.post(api, data={"chat_id": str(chat_id),
+                                             "text": mes2,
+                                             "parse_mode": "Markdown",
+                                             "disable_web_page_preview": True})
+            if r.status_code == 200:
+                return r
+        except httpx.RequestError as e:
+            print(f"⚠️ Ошибка запроса к Telegram: {e}")
+        await asyncio.sleep(3)
+    else:
+        try:
+            r = await client.post(api, data={"chat_id": str(chat_id),
+                                             "text": mes,
+                                             "disable_web_page_preview": True})
+            if r.status_code != 200:
+                print(f"Telegram 400: {r.text}")
+            return r
+        except httpx.RequestError as e:
+            print(f"⚠️ Ошибка запроса к Telegram: {e}")
+    return None
+
+
+async def delete_telegram_message(token: str, response: httpx.Response) -> None:
+    """Удаление сообщения, отправленного ботом `token` (дубль при хеджировании)"""
+
+    try:
+        result = response.json()["result"]
+        await resources.telegram.post(f"{TELEGRAM_API_URL}/bot{token}/deleteMessage",
+                                      data={"chat_id": result["chat"]["id"], "message_id": result["message_id"]})
+    except (httpx.RequestError, ValueError, KeyError, TypeError) as e:
+        print(f"⚠️ Не удалось удалить дубль в Telegram: {e}")
 
-    async with httpx.AsyncClient(proxy=PROXY, timeout=timeout) as client:
-        for _ in range(1):
-            try:
-                r = await client.post(api, data={"chat_id": NOVOFON_CHAT_ID,
-                                                 "text": mes2,
-                                                 "parse_mode": "Markdown",
-                                                 "disable_web_page_preview": True})
-                if r.status_code == 200:
-                    break
-            except httpx.RequestError as e:
-                print(f"⚠️ Ошибка запроса к Telegram: {e}")
-            await asyncio.sleep(3)
-        else:
-            try:
-                r = await client.post(api, data={"chat_id": NOVOFON_CHAT_ID,
-                                                 "text": mes,
-                                                 "disable_web_page_preview": True})
-                if r.status_code != 200:
-                    print(f"Telegram 400: {r.text}")
-            except httpx.RequestError as e:
-                print(f"⚠️ Ошибка запроса к Telegram: {e}")
+
+async def request_telegram2(mes: str):
+    await send_telegram(NOVOFON_BOT_TOKEN, NOVOFON_CHAT_ID, mes, escape_mdv2(mes))
 
 
-async def request_telegram(mes: str, db_conn: DbConnection, phone: str = None, marketplace: str = None):
+async def request_telegram(mes: str, db_conn: DbConnection, phone: str = None, marketplace: str = None,
+                           route: Route = None):
     mes2 = escape_mdv2(mes)
 
     async def reg(tg_id: str = None):
-        timeout = httpx.Timeout(10.0, connect=5.0)
-
         # Поддержка одного бота (строка) и нескольких (список токенов)
         tokens = TELEGRAM_BOT_TOKEN if isinstance(TELEGRAM_BOT_TOKEN, (list, tuple)) else [TELEGRAM_BOT_TOKEN]
 
@@ -121,36 +169,28 @@ async def request_telegram(mes: str, db_conn: DbConnection, phone: str = None, m
             tg_id = [tg_id]
 
         for id_tg in tg_id:
+            if TELEGRAM_HEDGED and len(tokens) > 1:
+                # Одно сообщение получателю: запасной бот подключается, только если основной медлит
+                async def send(token: str, chat_id=id_tg):
+                    r = await send_telegram(token, chat_id, mes, mes2)
+                    return r if r is not None and r.status_code == 200 else None
+
+                await hedged_send(list(tokens), send, delete_telegram_message)
+                continue
+
             for token in tokens:
-                api = f"https://api.telegram.org/bot{token}/sendMessage"
-                async with httpx.AsyncClient(proxy=PROXY, timeout=timeout) as client:
-                    for _ in range(1):
-                        try:
-                            r = await client.post(api, data={"chat_id": str(id_tg),
-                                                             "text": mes2,
-                                                             "parse_mode": "Markdown",
-                                                             "disable_web_page_preview": True})
-                            if r.status_code == 200:
-                                break
-                        except httpx.RequestError as e:
-                            print(f"⚠️ Ошибка запроса к Telegram: {e}")
-                        await asyncio.sleep(3)
-                    else:
-                        try:
-                            r = await client.post(api, data={"chat_id": str(id_tg),
-                                                             "text": mes,
-                                                             "disable_web_page_preview": True})
-                            if r.status_code != 200:
-                                print(f"Telegram 400: {r.text}")
-                        except httpx.RequestError as e:
-                            print(f"⚠️ Ошибка запроса к Telegram: {e}")
+                await send_telegram(token, id_tg, mes, mes2)
 
     if phone is None:
         phone = mes2.split('\n')[0].split()[-1]
 
-    if phone == '79340060237':
+    if route is None:
+        route = routing.lookup(phone)
+
+    # Особая пересылка: все сообщения номера — только указанному получателю
+    if route.forward_to is not None:
         try:
-            await reg('7796462930')
+            await reg(route.forward_to)
         except:
             pass
         return
@@ -189,26 +229,74 @@ class IPFilterMiddleware(BaseHTTPMiddleware):
         return await call_next(request)
 
 
-# Инициализация FastAPI-приложения с мидлваром
-app = FastAPI(middleware=[Middleware(IPFilterMiddleware, allowed_ips=ALLOWED_IPS)])
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """Старт: engines, HTTP-клиенты и прогрев кэшей до приёма трафика. Остановка: закрытие всего."""
 
+    await resources.startup()
 
-async def get_db():
-    session = SessionLocal()
-    db = DbConnection(session)
+    # Таблица маршрутизации: актуальная версия и перечитывание (по mtime и SIGHUP) в каждом воркере
     try:
-        yield db
-    finally:
-        session.close()
+        await run_in_threadpool(routing.reload)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ routing: {e}")
+    routing.start()
+
+    # Версия приложения — заранее, но без повторов: при ошибке БД кэш заполнит первый запрос /download_app
+    try:
+        await asyncio.wait_for(run_in_threadpool(refresh_version, DbConnection(SessionLocal, retries=1)),
+                               DB_WARM_TIMEOUT)
+    except asyncio.TimeoutError:
+        print("⚠️ Версия приложения не получена за DB_WARM_TIMEOUT")
+    except Exception as e:
+        print(f"⚠️ Не удалось получить версию приложения: {e}")
+
+    # Соединение с Bot API (TLS через прокси) устанавливается заранее
+    tokens = TELEGRAM_BOT_TOKEN if isinstance(TELEGRAM_BOT_TOKEN, (list, tuple)) else [TELEGRAM_BOT_TOKEN]
+    try:
+        await resources.telegram.get(f"{TELEGRAM_API_URL}/bot{tokens[0]}/getMe")
+    except httpx.RequestError as e:
+        print(f"⚠️ Telegram недоступен при старте: {e}")
+
+    log_ingest.start(write_logs)
+
+    yield
+
+    await routing.stop()
+    await pipeline.stop()
+    await log_ingest.stop()
+    await tracing.flush()
+    await resources.shutdown()
+
+
+# Инициализация FastAPI-приложения с мидлварами (запись трафика включается через CAPTURE_FILE)
+app = FastAPI(lifespan=lifespan, middleware=[Middleware(IPFilterMiddleware, allowed_ips=ALLOWED_IPS),
+                          Middleware(TrafficRecorderMiddleware)])
+
+
+def require_admin(request: Request) -> None:
+    """Проверка доступа к служебным эндпоинтам"""
 
+    if not ADMIN_API_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_API_TOKEN:
+        raise HTTPException(status_code=403, detail="Forbidden")
 
-async def get_db2():
-    session = SessionLocal2()
-    db = DbConnection(session)
+
+def fix_notification_time(notification_time: str) -> datetime:
+    """Преобразование времени уведомления Novofon к московскому часовому поясу"""
+
+    notification_time = datetime.strptime(notification_time, "%Y-%m-%d %H:%M:%S.%f")
+    now_time = datetime.now(tz=timezone(timedelta(hours=3))).replace(tzinfo=None)
+    hours = round((now_time - notification_time).total_seconds() / 3600)
+    return notification_time + timedelta(hours=hours)
+
+
+async def get_db():
+    # Соединение берётся из пула только внутри методов DbConnection; чтения — в реплику, если она настроена
+    db = DbConnection(SessionLocal, read_session_factory=SessionReplica)
     try:
         yield db
     finally:
-        session.close()
+        db.release()
 
 
 @app.get("/myip")
@@ -216,52 +304,165 @@ async def get_ip(request: Request):
     return {"ip": request.client.host}
 
 
+# Поиск запроса кода повторяется, пока запрос не появится в phone_message (как в add_message),
+# но пауза между попытками проходит вне слота этапа записи и не занимает его
+MATCH_ATTEMPTS = 10
+MATCH_RETRY_DELAY = 3  # секунд
+
+
+@dataclass
+class IncomingMessage:
+    """Входящее SMS/звонок, разобранное обработчиком вебхука и проходящее этапы конвейера"""
+
+    source: str  # novofon_call / novofon_sms / mts
+    phone: str  # 10 цифр номера получателя — ключ порядка обработки
+    time_response: datetime
+    trace: Trace
+    bot_text: str  # текст для бота
+    bot_phone: str  # номер для выбора получателей в боте (get_tg_id)
+    route: Route = DEFAULT_ROUTE
+    marketplace: str | list[str] | None = None  # площадка(и) для фильтра получателей в боте
+    to_bot: bool = True  # дублировать в бота (для Novofon — по маршруту номера)
+    novofon_text: str | None = None  # копия в общий Novofon-чат
+    code: str | None = None  # что сопоставлять в БД
+    code_marketplace: str | None = None
+    code_secondary: bool = False  # код пишется во вторую БД (add_code), а не сопоставляется (add_message)
+    match_attempts: int = MATCH_ATTEMPTS  # 1 — сообщение без кода: записывается одной попыткой, без ожидания запроса
+    attempts: int = 0  # сколько раз искали запрос кода в основной БД
+    matched: bool | None = None
+    error: Exception | None = None
+
+
+async def persist_message(job: IncomingMessage) -> float | None:
+    """
+    Этап записи: сопоставление кода в основной БД или запись во вторую.
+
+    Если запрос кода ещё не найден, возвращает паузу до следующей попытки.
+    """
+
+    if job.code is None:
+        return None
+    try:
+        if job.code_secondary:
+            if not secondary_configured():
+                print(f"⚠️ DB_URL2 не задан — код для {job.phone} не сохранён во вторую БД")
+                return None
+            with job.trace.span("add_code"):
+                await run_in_threadpool(DbConnection(SessionLocal2).add_code,
+                                        virtual_phone_number=job.phone,
+                                        time_response=job.time_response,
+                                        code=job.code)
+            return None
+
+        job.matched = False
+        if job.code_marketplace is None and job.source == "novofon_sms":
+            raise ValueError("площадка отправителя не определена")
+        job.attempts += 1
+        db_conn = DbConnection(SessionLocal, read_session_factory=SessionReplica)
+        with job.trace.span("add_message", attempt=job.attempts):
+            matched = await run_in_threadpool(db_conn.add_message,
+                                              virtual_phone_number=job.phone,
+                                              time_response=job.time_response,
+                                              message=job.code,
+                                              marketplace=job.code_marketplace,
+                                              attempts=1)
+        if not matched:
+            return MATCH_RETRY_DELAY if job.attempts < job.match_attempts else None
+        job.matched = True
+        job.trace.mark_match()
+        job.trace.marketplace = matched
+        return None
+    except Exception as e:
+        job.error = e
+        raise
+
+
+async def notify_message(job: IncomingMessage) -> None:
+    """Этап рассылки: копия в Novofon-чат и сообщение в бота (получатели — по маршруту и get_tg_id)"""
+
+    if job.novofon_text is not None:
+        try:
+            with job.trace.span("telegram.novofon"):
+                await request_telegram2(job.novofon_text)
+        except:
+            pass
+
+    if job.to_bot:
+        db_conn = DbConnection(SessionLocal, read_session_factory=SessionReplica)
+        try:
+            with job.trace.span("telegram.bot", marketplace=job.marketplace):
+                await request_telegram(job.bot_text, db_conn, phone=job.bot_phone,
+                                       marketplace=job.marketplace, route=job.route)
+        except Exception as e:
+            print(f'{str(e)}')
+
+
+async def finish_message(job: IncomingMessage) -> None:
+    await job.trace.finish(matched=job.matched)
+
+
+# Конвейер входящих сообщений: разбор и классификация — в обработчике вебхука,
+# запись и рассылка — независимыми этапами: каждый с порядком по номеру получателя
+# и параллельно для разных номеров, рассылка не ждёт сопоставления кода
+pipeline = KeyedPipeline([
+    ("persist", persist_message, PIPELINE_PERSIST_CONCURRENCY),
+    ("notify", notify_message, PIPELINE_NOTIFY_CONCURRENCY),
+], on_done=finish_message)
+
+
+async def dispatch_message(job: IncomingMessage) -> str:
+    """Передача сообщения в конвейер. Возвращает details для ответа вебхуку."""
+
+    done = pipeline.submit(job.phone, job)
+    if PIPELINE_BACKGROUND:
+        return "Сообщение принято"
+    await done
+    return f"Ошибка сообщения: {str(job.error)}" if job.error else "Сообщение получено"
+
+
 @app.get("/call")
 async def get_call(virtual_phone_number: str,
                    notification_time: str,
-                   contact_phone_number: str,
-                   db_conn: DbConnection = Depends(get_db)) -> JSONResponse:
+                   contact_phone_number: str) -> JSONResponse:
     """Эндпоинт для обработки звонка (без сообщения, код — последние 6 цифр номера)"""
+    trace = Trace("novofon_call")
     try:
         text = ""
 
         # Очистка номера от лишних символов, оставляем только 10 цифр
         virtual_phone_number = re.sub(r'\D', '', virtual_phone_number)[-10:]
+        trace.phone = virtual_phone_number
+        trace.marketplace = ['Ozon', 'Yandex']  # кандидаты; при сопоставлении заменяется найденной площадкой
 
-        # Преобразование времени уведомления к московскому часовому поясу
-        notification_time = datetime.strptime(notification_time, "%Y-%m-%d %H:%M:%S.%f")
-        now_time = datetime.now(tz=timezone(timedelta(hours=3))).replace(tzinfo=None)
-        hours = round((now_time - notification_time).total_seconds() / 3600)
-        notification_time += timedelta(hours=hours)
+        with trace.span("time_fixup") as span:
+            notification_time = fix_notification_time(notification_time)
+            span["attributes"]["notification_time"] = str(notification_time)
 
         text += f"В {str(notification_time).split('.')[0]} на ваш номер 7{virtual_phone_number} поступил звонок.\n"
         text += f"Номер с которого поступил вызов: {contact_phone_number}"
 
-        try:
-            await request_telegram2(text)
-        except:
-            pass
-
-        # Звонок → отправляем тем, у кого отмечен Ozon или Yandex (звонки-верификация идут с этих площадок)
-        if virtual_phone_number in NOVOFON_TO_BOT:
-            try:
-                await request_telegram(text, db_conn, phone=f'7{virtual_phone_number}',
-                                       marketplace=['Ozon', 'Yandex'])
-            except:
-                pass
-
         # Последние 6 цифр контактного номера используются как "сообщение"
         contact_phone_number = re.sub(r'\D', '', contact_phone_number)
-        message = contact_phone_number[-6:]
-
-        # Сохраняем информацию в БД
-        await run_in_threadpool(db_conn.add_message,
-                                virtual_phone_number=virtual_phone_number,
-                                time_response=notification_time,
-                                message=message)
-        details = "Сообщение получено"
+
+        route = routing.lookup(virtual_phone_number)
+
+        # Звонок → в бота тем, у кого отмечен Ozon или Yandex (звонки-верификация идут с этих площадок)
+        details = await dispatch_message(IncomingMessage(
+            source="novofon_call",
+            phone=virtual_phone_number,
+            time_response=notification_time,
+            trace=trace,
+            bot_text=text,
+            bot_phone=f'7{virtual_phone_number}',
+            route=route,
+            marketplace=['Ozon', 'Yandex'],
+            to_bot=route.novofon_to_bot,
+            novofon_text=text,
+            code=contact_phone_number[-6:],
+        ))
     except Exception as e:
         details = f"Ошибка сообщения: {str(e)}"
+        await trace.finish(matched=False)
     return JSONResponse(
         status_code=200,
         content={"status": "ok", "details": details},
@@ -273,20 +474,19 @@ async def get_call(virtual_phone_number: str,
 async def get_sms(virtual_phone_number: str,
                   notification_time: str,
                   contact_phone_number: str,
-                  message: str,
-                  db_conn: DbConnection = Depends(get_db)) -> JSONResponse:
+                  message: str) -> JSONResponse:
     """Эндпоинт для обработки СМС с кодом"""
+    trace = Trace("novofon_sms")
     try:
         text = ""
 
         # Очистка номера от лишних символов, оставляем только 10 цифр
         virtual_phone_number = re.sub(r'\D', '', virtual_phone_number)[-10:]
+        trace.phone = virtual_phone_number
 
-        # Преобразование времени уведомления к московскому часовому поясу
-        notification_time = datetime.strptime(notification_time, "%Y-%m-%d %H:%M:%S.%f")
-        now_time = datetime.now(tz=timezone(timedelta(hours=3))).replace(tzinfo=None)
-        hours = round((now_time - notification_time).total_seconds() / 3600)
-        notification_time += timedelta(hours=hours)
+        with trace.span("time_fixup") as span:
+            notification_time = fix_notification_time(notification_time)
+            span["attributes"]["notification_time"] = str(notification_time)
 
         text += f"В {str(notification_time).split('.')[0]} "
         text += f"на ваш номер 7{virtual_phone_number} пришло сообщение от {contact_phone_number}.\n"
@@ -296,43 +496,33 @@ async def get_sms(virtual_phone_number: str,
         message = unquote(message)
         text += f"{message}"
 
-        try:
-            await request_telegram2(text)
-        except:
-            pass
-
-        # Дублируем в бота: «безномерным» — по галочкам МП, привязанным к номеру — всегда
-        if virtual_phone_number in NOVOFON_TO_BOT:
-            try:
-                mkt = detect_marketplace(contact_phone_number, message)
-                await request_telegram(text, db_conn, phone=f'7{virtual_phone_number}', marketplace=mkt)
-            except:
-                pass
-
-        patterns = [
-            (r'\b\d{6}\b', lambda s: s),
-            (r'\b\d{3}-\d{3}\b', lambda s: s.replace('-', '')),
-            (r'\b\d{4}\b', lambda s: s),
-        ]
-
-        for pattern, transform in patterns:
-            match = re.search(pattern, message)
-            if match:
-                message = transform(match.group(0))
-                break
-
         # Сопоставление названия платформы с кодом
         marketplace = {'Wildberries': 'WB', 'OZON.ru': 'Ozon', 'Yandex': 'Yandex', 'M.Video': 'МВидео'}
-
-        # Сохраняем информацию в БД
-        await run_in_threadpool(db_conn.add_message,
-                                virtual_phone_number=virtual_phone_number,
-                                time_response=notification_time,
-                                message=message,
-                                marketplace=marketplace[contact_phone_number])
-        details = "Сообщение получено"
+        trace.marketplace = marketplace.get(contact_phone_number)
+
+        route = routing.lookup(virtual_phone_number)
+        code = extract_code(message, SMS_CODE_PATTERNS)
+
+        # Дублируем в бота: «безномерным» — по галочкам МП, привязанным к номеру — всегда.
+        # Код из текста; если не найден — в БД уходит сообщение целиком, одной попыткой (ждать запрос незачем)
+        details = await dispatch_message(IncomingMessage(
+            source="novofon_sms",
+            phone=virtual_phone_number,
+            time_response=notification_time,
+            trace=trace,
+            bot_text=text,
+            bot_phone=f'7{virtual_phone_number}',
+            route=route,
+            marketplace=detect_marketplace(contact_phone_number, message),
+            to_bot=route.novofon_to_bot,
+            novofon_text=text,
+            code=code or message,
+            code_marketplace=marketplace.get(contact_phone_number),
+            match_attempts=MATCH_ATTEMPTS if code else 1,
+        ))
     except Exception as e:
         details = f"Ошибка сообщения: {str(e)}"
+        await trace.finish(matched=False)
     return JSONResponse(
         status_code=200,
         content={"status": "ok", "details": details},
@@ -340,12 +530,32 @@ async def get_sms(virtual_phone_number: str,
     )
 
 
+# Кэш версии приложения: таблица version меняется только при выпуске новой сборки
+VERSION_CACHE_TTL = getattr(config, "VERSION_CACHE_TTL", 60)  # секунд
+_version_cache = {"value": None, "at": 0.0}
+
+
+def refresh_version(db_conn: DbConnection = None) -> str:
+    """Чтение версии из БД в кэш"""
+
+    db_conn = db_conn or DbConnection(SessionLocal, read_session_factory=SessionReplica)
+    version = db_conn.get_version()
+    _version_cache.update(value=version, at=time.monotonic())
+    return version
+
+
+async def get_version(db_conn: DbConnection) -> str:
+    if _version_cache["value"] is not None and time.monotonic() - _version_cache["at"] < VERSION_CACHE_TTL:
+        return _version_cache["value"]
+    return await run_in_threadpool(refresh_version, db_conn)
+
+
 @app.get("/download_app")
 async def get_app(db_conn: DbConnection = Depends(get_db)):
     """Эндпоинт для скачивания zip-файла приложения браузера"""
 
     try:
-        version = await run_in_threadpool(db_conn.get_version)
+        version = await get_version(db_conn)
 
         # Итеративная передача файла по частям
         def iterfile():
@@ -363,19 +573,37 @@ async def get_app(db_conn: DbConnection = Depends(get_db)):
         return {"error": "File not found"}
 
 
+def write_logs(rows: list[dict]) -> None:
+    """Запись свёрнутых событий /log (вызывается из log_ingest в пуле потоков)"""
+
+    DbConnection(SessionLocal, read_session_factory=SessionReplica).add_logs(rows)
+
+
 @app.post("/log")
-async def get_log(entry: LogEntry, db_conn: DbConnection = Depends(get_db)) -> dict:
+async def get_log(entry: LogEntry, request: Request, db_conn: DbConnection = Depends(get_db)) -> dict:
     """Эндпоинт для логирования событий из клиента"""
 
-    await run_in_threadpool(db_conn.add_log, **entry.dict())
-    return {"status": "success", "message": "Log saved successfully"}
+    data = normalize_timestamps(entry.dict())
+
+    # Ошибки пишутся сразу и всегда; остальное сворачивается, лимитируется и выборочно сохраняется
+    if log_ingest.always_keep(data):
+        await run_in_threadpool(db_conn.add_log, **data)
+        return {"status": "success", "message": "Log saved successfully"}
+
+    client_ip = request.headers.get("X-Forwarded-For", request.client.host).split(",")[0].strip()
+    result = log_ingest.ingest(data, client_ip)
+    if result == SAVED:
+        # Событие в буфере, в БД попадёт при ближайшей записи
+        return {"status": "success", "message": "Log accepted"}
+    if result == AGGREGATED:
+        return {"status": "success", "message": "Log aggregated"}
+    return {"status": "success", "message": f"Log dropped: {result}"}
 
 
 @app.post("/mts")
-async def get_mts(request: Request,
-                  db_conn: DbConnection = Depends(get_db),
-                  db_conn2: DbConnection = Depends(get_db2)) -> JSONResponse:
+async def get_mts(request: Request) -> JSONResponse:
     """Эндпоинт для получения смс на виртуальные номера MTS"""
+    trace = Trace("mts")
     try:
         body = {}
         raw = "Пустое сообщение"
@@ -414,73 +642,82 @@ async def get_mts(request: Request,
                 body = {}
 
         if msg:
+            trace.phone = msg.receiver[1:]
             if is_duplicate_message(msg):
                 print(f"Дубль в пределах {DEDUP_WINDOW}s — пропуск: {msg.sender} {msg.receiver}")
                 return JSONResponse(status_code=200, content={"status": "ok", "duplicate": True})
 
-            try:
-                text = msg.text.replace('*', '\\*')
-                marketplace = detect_marketplace(msg.sender, msg.text)
-                # Кому уйдёт — решает get_tg_id: «безномерным» по галочкам МП,
-                # привязанным к этому номеру — всегда (даже если площадка не распознана)
-                await request_telegram(f"*На номер:* {msg.receiver}\n"
-                                       f"*От:* {msg.sender}\n\n"
-                                       f"*Сообщение:*\n"
-                                       f"{text}",
-                                       db_conn=db_conn,
-                                       marketplace=marketplace)
-                print(msg.sender, msg.receiver, msg.text)
-
-                # Дублируем сообщения этих номеров в общий Novofon-чат
-                if msg.receiver[1:] in ('9393276833', '9681978744', '9820909411', '9064961724', '9667786703'):
-                    try:
-                        await request_telegram2(f"На номер: {msg.receiver}\n"
-                                                f"От: {msg.sender}\n\n"
-                                                f"Сообщение:\n{msg.text}")
-                    except:
-                        pass
-
-                if msg.receiver[1:] in ('9393276833', '9681978744','9820909411','9064961724','9667786703'):
-                    if msg.sender == 'Wildberries':
-                        code = ""
-                        phone = msg.receiver[1:]
-                        match = re.search(r'\b\d{6}\b', msg.text)
-                        if match:
-                            code = match.group(0)
-                        else:
-                            match = re.search(r'\b\d{3}-\d{3}\b', msg.text)
-                            if match:
-                                code = match.group(0).replace('-', '')
-                        if code:
-                            await run_in_threadpool(db_conn.add_message,
-                                                    virtual_phone_number=phone,
-                                                    time_response=notification_time,
-                                                    message=code,
-                                                    marketplace='WB')
-                elif msg.sender == 'Wildberries':
-                    code = ""
-                    phone = msg.receiver[1:]
-                    match = re.search(r'\b\d{6}\b', msg.text)
-                    if match:
-                        code = match.group(0)
-                    else:
-                        match = re.search(r'\b\d{3}-\d{3}\b', msg.text)
-                        if match:
-                            code = match.group(0).replace('-', '')
-                    if code:
-                        db_conn2.add_code(virtual_phone_number=phone, time_response=notification_time, code=code)
-
-                return JSONResponse(status_code=200, content={"status": "ok"})
-            except Exception as e:
-                print(f'{str(e)}')
+            text = msg.text.replace('*', '\\*')
+            marketplace = detect_marketplace(msg.sender, msg.text)
+            route = routing.lookup(msg.receiver)
+            trace.marketplace = marketplace
+            print(msg.sender, msg.receiver, msg.text)
+
+            # WB-код: номера с wb_primary сопоставляются в основной БД, остальные пишутся во вторую
+            code = extract_code(msg.text, MTS_CODE_PATTERNS) if msg.sender == 'Wildberries' else None
+
+            # Кому уйдёт — решает get_tg_id: «безномерным» по галочкам МП,
+            # привязанным к этому номеру — всегда (даже если площадка не распознана).
+            # Сообщения номеров с mirror_to_novofon дублируются в общий Novofon-чат
+            await dispatch_message(IncomingMessage(
+                source="mts",
+                phone=msg.receiver[1:],
+                time_response=notification_time,
+                trace=trace,
+                bot_text=f"*На номер:* {msg.receiver}\n"
+                         f"*От:* {msg.sender}\n\n"
+                         f"*Сообщение:*\n"
+                         f"{text}",
+                bot_phone=msg.receiver,
+                route=route,
+                marketplace=marketplace,
+                novofon_text=(f"На номер: {msg.receiver}\n"
+                              f"От: {msg.sender}\n\n"
+                              f"Сообщение:\n{msg.text}") if route.mirror_to_novofon else None,
+                code=code,
+                code_marketplace='WB',
+                code_secondary=not route.wb_primary,
+            ))
+            return JSONResponse(status_code=200, content={"status": "ok"})
 
         tokens = TELEGRAM_BOT_TOKEN if isinstance(TELEGRAM_BOT_TOKEN, (list, tuple)) else [TELEGRAM_BOT_TOKEN]
         payload = {"chat_id": str(TELEGRAM_CHAT_ID), "text": body or raw}
-        async with httpx.AsyncClient() as client:
-            for token in tokens:
-                api = f"https://api.telegram.org/bot{token}/sendMessage"
-                await client.post(api, data=payload)
+        for token in tokens:
+            api = f"{TELEGRAM_API_URL}/bot{token}/sendMessage"
+            await resources.http.post(api, data=payload)
 
         return JSONResponse(status_code=200, content={"status": "ok"})
     except Exception as e:
         return JSONResponse(status_code=500, content={"status": "error", "details": str(e)})
+
+
+@app.post("/admin/routing/reload", dependencies=[Depends(require_admin)])
+async def reload_routing() -> dict:
+    """Перечитывание таблицы маршрутизации номеров без перезапуска (в воркере, принявшем запрос)"""
+
+    try:
+        table = await run_in_threadpool(routing.reload)
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Ошибка таблицы маршрутизации: {e}")
+    return table.summary()
+
+
+@app.get("/admin/slow_queries", dependencies=[Depends(require_admin)])
+async def get_slow_queries(limit: int = 20) -> list[dict]:
+    """Самые дорогие SQL-запросы по суммарному времени, с методом DbConnection и числом медленных выполнений"""
+
+    return top_queries(limit)
+
+
+@app.get("/admin/otp_report", dependencies=[Depends(require_admin)])
+async def get_otp_report() -> dict:
+    """Отчёт по задержке от прихода SMS/звонка до сопоставления кода, по площадкам и номерам"""
+
+    return trace_report()
+
+
+@app.get("/admin/pipeline", dependencies=[Depends(require_admin)])
+async def get_pipeline_stats() -> dict:
+    """Загрузка конвейера входящих сообщений: очереди по этапам, активные номера, ошибки этапов"""
+
+    return pipeline.stats()
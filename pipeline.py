@@ -0,0 +1,164 @@
+import asyncio
+
+from collections import deque
+from typing import Awaitable, Callable, NamedTuple
+
+import config
+
+# Входящие SMS/звонки обрабатываются в фоне: вебхук отвечает сразу после разбора.
+# Выключено — обработчик ждёт, пока сообщение пройдёт все этапы (порядок по номеру сохраняется в обоих режимах).
+PIPELINE_BACKGROUND = getattr(config, "PIPELINE_BACKGROUND", False)
+# Сколько сообщений (разных номеров) одновременно на этапе записи в БД — не больше пула соединений
+PIPELINE_PERSIST_CONCURRENCY = getattr(config, "PIPELINE_PERSIST_CONCURRENCY", 8)
+# Сколько сообщений одновременно на этапе рассылки в Telegram
+PIPELINE_NOTIFY_CONCURRENCY = getattr(config, "PIPELINE_NOTIFY_CONCURRENCY", 32)
+# Сколько ждать дообработки очереди при остановке (секунд)
+PIPELINE_DRAIN_TIMEOUT = getattr(config, "PIPELINE_DRAIN_TIMEOUT", 30)
+
+
+class Stage(NamedTuple):
+    """
+    Этап конвейера: обработчик сообщения и общий для всех номеров лимит параллельности.
+
+    Обработчик может вернуть число секунд — тогда он будет вызван для того же сообщения
+    повторно через это время. На время паузы слот лимита освобождается, а более новые сообщения
+    номера на этом этапе обрабатываются раньше ожидающего (см. KeyedPipeline).
+    """
+
+    name: str
+    handler: Callable[[object], Awaitable[float | None]]
+    limit: asyncio.Semaphore
+
+
+class _Entry:
+    """Сообщение в конвейере: сколько этапов ещё не завершено и чего ждёт отправитель"""
+
+    __slots__ = ("job", "remaining", "future", "retry_at")
+
+    def __init__(self, job, remaining: int, future: asyncio.Future):
+        self.job = job
+        self.remaining = remaining
+        self.future = future
+        self.retry_at: dict[int, float] = {}  # этап -> время (loop.time()) следующей попытки
+
+
+class KeyedPipeline:
+    """
+    Независимые этапы с порядком по ключу (номеру получателя).
+
+    Сообщение ставится сразу в очереди всех этапов. На каждом этапе у ключа своя очередь
+    и не больше одного воркера, поэтому сообщения одного номера проходят этап строго в порядке
+    поступления. Исключение — сообщение, ожидающее повтора (обработчик вернул паузу): пока оно
+    ждёт, более новые сообщения номера проходят этап без очереди, а оно повторяется позже.
+    Так код, пришедший раньше своего запроса, не задерживает следующие коды номера на всё время
+    ожидания (порядок уступает задержке только для ожидающих сообщений).
+    Этапы друг друга не ждут: рассылка не задерживается записью в БД.
+    Разные номера обрабатываются параллельно в пределах лимита этапа. Воркер завершается,
+    когда очередь ключа пуста, так что простаивающие номера не держат задачи.
+    on_done(job) вызывается, когда сообщение прошло все этапы. Вызывается только из event loop.
+    """
+
+    def __init__(self, stages: list[tuple[str, Callable, int]], on_done: Callable[[object], Awaitable] = None):
+        self.stages = [Stage(name, handler, asyncio.Semaphore(limit)) for name, handler, limit in stages]
+        self.on_done = on_done
+        self._queues: dict[tuple[int, str], deque] = {}
+        self._wakeups: dict[tuple[int, str], asyncio.Event] = {}
+        self._workers: set[asyncio.Task] = set()
+        self.errors = {stage.name: 0 for stage in self.stages}
+
+    def submit(self, key: str, job) -> asyncio.Future:
+        """Постановка сообщения в очереди номера. Future завершается, когда сообщение прошло все этапы."""
+
+        entry = _Entry(job, len(self.stages), asyncio.get_running_loop().create_future())
+        for index in range(len(self.stages)):
+            self._enqueue(index, key, entry)
+        return entry.future
+
+    def _enqueue(self, index: int, key: str, entry: _Entry) -> None:
+        queue = self._queues.get((index, key))
+        if queue is not None:
+            queue.append(entry)  # воркер этапа для номера уже работает — он и заберёт
+            self._wakeups[(index, key)].set()  # даже если сейчас он ждёт повтора другого сообщения
+            return
+        self._queues[(index, key)] = deque([entry])
+        self._wakeups[(index, key)] = asyncio.Event()
+        worker = asyncio.create_task(self._work(index, key))
+        self._workers.add(worker)
+        worker.add_done_callback(self._workers.discard)
+
+    async def _run_stage(self, stage: Stage, key: str, job) -> float | None:
+        """Одна попытка этапа. Возвращает паузу до повтора или None, если этап для сообщения завершён."""
+
+        try:
+            async with stage.limit:
+                return await stage.handler(job)
+        except Exception as e:
+            # Ошибка этапа не мешает другим этапам того же сообщения
+            self.errors[stage.name] += 1
+            print(f"⚠️ pipeline: ошибка этапа {stage.name} для {key}: {e}")
+            return None
+
+    async def _work(self, index: int, key: str) -> None:
+        stage = self.stages[index]
+        queue = self._queues[(index, key)]
+        wakeup = self._wakeups[(index, key)]
+        loop = asyncio.get_running_loop()
+        while queue:
+            # Первое по порядку сообщение, не ожидающее повтора
+            now = loop.time()
+            entry = next((e for e in queue if e.retry_at.get(index, 0) <= now), None)
+            if entry is None:
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), min(e.retry_at[index] for e in queue) - now)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            delay = await self._run_stage(stage, key, entry.job)
+            if delay:
+                entry.retry_at[index] = loop.time() + delay
+                continue
+            queue.remove(entry)
+
+            entry.remaining -= 1
+            if entry.remaining == 0:
+                if self.on_done is not None:
+                    try:
+                        await self.on_done(entry.job)
+                    except Exception as e:
+                        print(f"⚠️ pipeline: ошибка завершения для {key}: {e}")
+                if not entry.future.done():
+                    entry.future.set_result(entry.job)
+        del self._queues[(index, key)]
+        del self._wakeups[(index, key)]
+
+    def stats(self) -> dict:
+        """Текущая загрузка: сообщений в очередях по этапам, активных номеров и ошибок этапов"""
+
+        queued = {stage.name: 0 for stage in self.stages}
+        for (index, _key), queue in self._queues.items():
+            queued[self.stages[index].name] += len(queue)
+        return {
+            "queued": queued,
+            "active_numbers": len({key for _index, key in self._queues}),
+            "errors": dict(self.errors),
+        }
+
+    async def stop(self, timeout: float = PIPELINE_DRAIN_TIMEOUT) -> None:
+        """Остановка: дообработка уже принятых сообщений (не дольше timeout), затем отмена оставшегося"""
+
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self._workers:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            await asyncio.wait(set(self._workers), timeout=remaining)
+
+        if self._workers:
+            print(f"⚠️ pipeline: не дообработано сообщений: {sum(map(len, self._queues.values()))}")
+            for worker in list(self._workers):
+                worker.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+            self._queues.clear()
+            self._wakeups.clear()
@@ -0,0 +1,213 @@
+"""
+Воспроизведение записанного трафика (см. capture.py) против локального экземпляра API.
+
+Пример:
+    python replay.py capture.jsonl.gz --target http://127.0.0.1:2613 --speed 10 --stub-telegram 8081 \
+        --telegram-log sent.jsonl
+
+Экземпляр API для replay запускается с TELEGRAM_API_URL = "http://127.0.0.1:8081" и PROXY = None,
+чтобы сообщения уходили в заглушку, а не в настоящий Telegram. Отправленное в заглушку
+сохраняется в --telegram-log в стабильном порядке: файлы двух прогонов (до и после изменения) сравниваются diff.
+"""
+
+import re
+import json
+import time
+import httpx
+import asyncio
+import argparse
+import threading
+
+from collections import defaultdict
+from urllib.parse import parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from capture import read_records, decode_body
+
+# Изменчивые части строк ответа (например, в details «Ошибка сообщения: ...»): заменяются при сравнении,
+# остальной текст сравнивается — по details видны ошибки add_message и разбора вебхука
+VOLATILE_PATTERNS = (
+    (re.compile(r"\(Background on this error at: [^)]*\)"), ""),
+    (re.compile(r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}(\.\d+)?"), "<time>"),
+    (re.compile(r"0x[0-9a-fA-F]+"), "<addr>"),
+    (re.compile(r"\s+"), " "),
+)
+
+
+class TelegramStubHandler(BaseHTTPRequestHandler):
+    """Заглушка Bot API: на любой метод отвечает успехом и запоминает, что было отправлено"""
+
+    sent = 0
+    messages: list[dict] = []
+    _lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            try:
+                params = json.loads(body)
+            except ValueError:
+                params = {}
+        else:
+            params = dict(parse_qsl(body.decode("utf-8", "ignore")))
+        with TelegramStubHandler._lock:
+            TelegramStubHandler.sent += 1
+            TelegramStubHandler.messages.append({
+                "method": self.path.rsplit("/", 1)[-1],
+                "chat_id": str(params.get("chat_id", "")),
+                "text": params.get("text"),
+                "parse_mode": params.get("parse_mode"),
+            })
+        payload = json.dumps({"ok": True, "result": {"message_id": TelegramStubHandler.sent}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_telegram_stub(port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", port), TelegramStubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _normalize_text(value: str) -> str:
+    for pattern, replacement in VOLATILE_PATTERNS:
+        value = pattern.sub(replacement, value)
+    return value.strip()
+
+
+def _normalize(status: int, body: bytes):
+    """Ответ в виде, пригодном для сравнения: JSON с заменёнными изменчивыми частями строк или сырой текст"""
+
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return status, _normalize_text(body.decode("utf-8", "ignore"))
+    if isinstance(data, dict):
+        data = {k: _normalize_text(v) if isinstance(v, str) else v for k, v in data.items()}
+    return status, data
+
+
+def write_telegram_log(path: str) -> None:
+    """Отправленное в заглушку — в JSONL, отсортированным (порядок при параллельном replay не детерминирован)"""
+
+    key = lambda m: (m["chat_id"], m["method"], m["text"] or "", m["parse_mode"] or "")
+    with open(path, "w", encoding="utf-8") as file:
+        for message in sorted(TelegramStubHandler.messages, key=key):
+            file.write(json.dumps(message, ensure_ascii=False, sort_keys=True) + "\n")
+
+
+def _percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(round(q * (len(values) - 1))))], 1)
+
+
+async def replay(records: list[dict], target: str, speed: float, concurrency: int) -> list[dict]:
+    """Повторная отправка запросов с сохранением интервалов между ними, ускоренных в `speed` раз"""
+
+    results = []
+    semaphore = asyncio.Semaphore(concurrency)
+    t0 = records[0]["ts"]
+    started = time.monotonic()
+
+    async with httpx.AsyncClient(base_url=target, timeout=httpx.Timeout(120.0)) as client:
+
+        async def send(record: dict):
+            delay = (record["ts"] - t0) / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with semaphore:
+                url = record["path"] + (f"?{record['query']}" if record["query"] else "")
+                request_started = time.perf_counter()
+                try:
+                    r = await client.request(record["method"], url,
+                                             content=decode_body(record["body"]),
+                                             headers=record["headers"])
+                    status, body = r.status_code, r.content
+                except httpx.RequestError as e:
+                    status, body = 0, str(e).encode()
+                latency_ms = (time.perf_counter() - request_started) * 1000
+
+            expected = _normalize(record["status"], decode_body(record["response"]))
+            actual = _normalize(status, body)
+            results.append({"path": record["path"],
+                            "recorded_ms": record["latency_ms"],
+                            "replay_ms": latency_ms,
+                            "ok": expected == actual,
+                            "expected": expected,
+                            "actual": actual})
+
+        await asyncio.gather(*(send(record) for record in records))
+    return results
+
+
+def print_report(results: list[dict], show_diffs: int) -> None:
+    by_path = defaultdict(list)
+    for result in results:
+        by_path[result["path"]].append(result)
+
+    print(f"{'path':<8} {'count':>6} {'diff':>5} {'rec p50':>8} {'rec p95':>8} {'new p50':>8} {'new p95':>8} {'new p99':>8}")
+    for path, items in sorted(by_path.items()):
+        recorded = [r["recorded_ms"] for r in items]
+        replayed = [r["replay_ms"] for r in items]
+        print(f"{path:<8} {len(items):>6} {sum(not r['ok'] for r in items):>5} "
+              f"{_percentile(recorded, 0.5):>8} {_percentile(recorded, 0.95):>8} "
+              f"{_percentile(replayed, 0.5):>8} {_percentile(replayed, 0.95):>8} {_percentile(replayed, 0.99):>8}")
+
+    diffs = [r for r in results if not r["ok"]]
+    for result in diffs[:show_diffs]:
+        print(f"\n{result['path']}: ожидалось {result['expected']}, получено {result['actual']}")
+    if len(diffs) > show_diffs:
+        print(f"\n... ещё расхождений: {len(diffs) - show_diffs}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика API")
+    parser.add_argument("capture", help="файл записи (CAPTURE_FILE)")
+    parser.add_argument("--target", default="http://127.0.0.1:2613", help="адрес локального экземпляра API")
+    parser.add_argument("--speed", type=float, default=1.0, help="ускорение времени: 1, 10, 100 ...")
+    parser.add_argument("--concurrency", type=int, default=100, help="максимум одновременных запросов")
+    parser.add_argument("--path", action="append", help="воспроизводить только эти пути (можно несколько)")
+    parser.add_argument("--stub-telegram", type=int, metavar="PORT", help="поднять заглушку Telegram на порту")
+    parser.add_argument("--telegram-log", metavar="FILE", help="сохранить отправленное в заглушку Telegram (для diff)")
+    parser.add_argument("--show-diffs", type=int, default=10, help="сколько расхождений вывести")
+    args = parser.parse_args()
+
+    records = [r for r in read_records(args.capture) if not args.path or r["path"] in args.path]
+    # Тела, которые при записи нельзя было замаскировать (multipart), не сохранялись — такие запросы пропускаются
+    dropped = sum(bool(r.get("body_dropped")) for r in records)
+    records = [r for r in records if not r.get("body_dropped")]
+    if dropped:
+        print(f"Пропущено запросов без сохранённого тела: {dropped}")
+    if not records:
+        print("Нет запросов для воспроизведения")
+        return
+    records.sort(key=lambda r: r["ts"])
+
+    stub = start_telegram_stub(args.stub_telegram) if args.stub_telegram else None
+    started = time.monotonic()
+    try:
+        results = asyncio.run(replay(records, args.target, args.speed, args.concurrency))
+    finally:
+        if stub:
+            stub.shutdown()
+
+    print(f"Воспроизведено {len(results)} запросов за {time.monotonic() - started:.1f}s "
+          f"(в записи {records[-1]['ts'] - records[0]['ts']:.1f}s, ускорение x{args.speed:g})")
+    if stub:
+        print(f"Сообщений в заглушку Telegram: {TelegramStubHandler.sent}")
+        if args.telegram_log:
+            write_telegram_log(args.telegram_log)
+            print(f"Отправленное в Telegram сохранено в {args.telegram_log}")
+    print_report(results, args.show_diffs)
+
+
+if __name__ == "__main__":
+    main()
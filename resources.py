@@ -0,0 +1,69 @@
+import httpx
+import asyncio
+
+from fastapi.concurrency import run_in_threadpool
+
+import config
+from database import bootstrap
+
+# Сколько соединений каждого пула открыть при старте, до приёма трафика
+DB_POOL_WARM = getattr(config, "DB_POOL_WARM", 5)
+# Сколько секунд старт ждёт прогрева (пулы — параллельно, версия приложения): прогрев не обязателен,
+# недоступная БД не задерживает запуск дольше этого времени
+DB_WARM_TIMEOUT = getattr(config, "DB_WARM_TIMEOUT", 3)
+
+
+class Resources:
+    """
+    Ресурсы приложения с общим временем жизни: engines БД и HTTP-клиенты.
+
+    Создаются в lifespan при старте (с прогревом пулов) и закрываются при остановке,
+    поэтому первый запрос после деплоя не платит за подключения и TLS-рукопожатия.
+    """
+
+    def __init__(self):
+        self.telegram: httpx.AsyncClient | None = None  # Bot API через PROXY
+        self.http: httpx.AsyncClient | None = None  # прочие запросы наружу (без прокси)
+
+    async def startup(self) -> None:
+        await run_in_threadpool(bootstrap.init_engines)
+
+        engines = [(name, db_engine) for name, db_engine in (("primary", bootstrap.engine),
+                                                             ("secondary", bootstrap.engine2),
+                                                             ("replica", bootstrap.engine_replica))
+                   if db_engine is not None]
+        await asyncio.gather(*(self._warm(name, db_engine) for name, db_engine in engines))
+
+        if bootstrap.engine_replica is not None:
+            try:
+                await asyncio.wait_for(run_in_threadpool(bootstrap.replica_available), DB_WARM_TIMEOUT)
+            except asyncio.TimeoutError:
+                print("⚠️ DB replica: проверка не уложилась в DB_WARM_TIMEOUT, чтение пока с primary")
+
+        self.telegram = httpx.AsyncClient(proxy=getattr(config, "PROXY", None),
+                                          timeout=httpx.Timeout(10.0, connect=5.0))
+        self.http = httpx.AsyncClient(timeout=httpx.Timeout(10.0, connect=5.0))
+
+    @staticmethod
+    async def _warm(name: str, db_engine) -> None:
+        """Прогрев пула без гарантий: одна попытка, не дольше DB_WARM_TIMEOUT (поток дорабатывает в фоне)"""
+
+        try:
+            opened = await asyncio.wait_for(run_in_threadpool(bootstrap.warm_pool, db_engine, DB_POOL_WARM),
+                                            DB_WARM_TIMEOUT)
+            print(f"DB {name}: прогрето соединений: {opened}")
+        except asyncio.TimeoutError:
+            print(f"⚠️ DB {name}: прогрев пула не уложился в {DB_WARM_TIMEOUT}s, продолжаем без него")
+        except Exception as e:
+            # БД может быть недоступна при старте — приложение всё равно запускается, как и раньше
+            print(f"⚠️ DB {name}: не удалось прогреть пул: {e}")
+
+    async def shutdown(self) -> None:
+        for client in (self.telegram, self.http):
+            if client is not None:
+                await client.aclose()
+        self.telegram = self.http = None
+        await run_in_threadpool(bootstrap.dispose_engines)
+
+
+resources = Resources()
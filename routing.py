@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import signal
+import asyncio
+import threading
+
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+from dataclasses import dataclass, field
+
+from fastapi.concurrency import run_in_threadpool
+
+import config
+
+# JSON-файл с таблицей маршрутизации номеров. Не задан или отсутствует — используются DEFAULT_ROUTING.
+# Источник из БД не реализован (нужна новая таблица и миграция); при появлении — добавляется в load_table().
+ROUTING_FILE = getattr(config, "ROUTING_FILE", None)
+# Как часто (секунд) проверять mtime файла (в фоне, вне event loop): так изменения подхватывают
+# все воркеры без перезапуска
+ROUTING_CHECK_INTERVAL = getattr(config, "ROUTING_CHECK_INTERVAL", 5)
+
+# Таблица по умолчанию. Номера — 10 цифр (без ведущей 7).
+DEFAULT_ROUTING = {
+    # Novofon-номера, звонки/SMS которых дополнительно дублируются в бота
+    # (адресно по привязке get_tg_id). Novofon-чат при этом получает копию как обычно.
+    "novofon_to_bot": [
+        "9240778433", "9333994170", "9952226756", "9843332141",
+        "9699992486", "9699997468", "9581110845", "9333994184",
+        "9240778126", "9240779171", "9581119477", "9860889534",
+    ],
+    # MTS-номера, сообщения которых дублируются в общий Novofon-чат
+    "mts_mirror": ["9393276833", "9681978744", "9820909411", "9064961724", "9667786703"],
+    # MTS-номера, WB-коды которых сопоставляются в основной БД (add_message); остальные — во второй (add_code)
+    "mts_primary": ["9393276833", "9681978744", "9820909411", "9064961724", "9667786703"],
+    # Номер -> Telegram ID: все сообщения номера уходят только этому получателю
+    "forwards": {"9340060237": "7796462930"},
+}
+
+
+class Route(NamedTuple):
+    """Решение по номеру: все маршруты одного номера, полученные за один поиск"""
+
+    novofon_to_bot: bool = False  # Novofon: дублировать в бота
+    mirror_to_novofon: bool = False  # MTS: дублировать в Novofon-чат
+    wb_primary: bool = False  # MTS: WB-код — в основную БД (add_message), иначе во вторую (add_code)
+    forward_to: str | None = None  # особая пересылка конкретному Telegram ID
+
+
+DEFAULT_ROUTE = Route()
+
+
+def normalize_phone(phone: str) -> str:
+    """Ключ таблицы: последние 10 цифр номера (79XXXXXXXXX, 9XXXXXXXXX и +7... дают один ключ)"""
+
+    return "".join(ch for ch in phone if ch.isdigit())[-10:]
+
+
+@dataclass(frozen=True)
+class RoutingTable:
+    """Скомпилированная неизменяемая таблица маршрутизации: номер -> Route"""
+
+    routes: Mapping[str, Route]
+    source: str = "default"
+    mtime: float | None = None
+    loaded_at: float = field(default_factory=time.time)
+
+    def lookup(self, phone: str) -> Route:
+        return self.routes.get(normalize_phone(phone or ""), DEFAULT_ROUTE)
+
+    def summary(self) -> dict:
+        return {
+            "source": self.source,
+            "loaded_at": self.loaded_at,
+            "numbers": len(self.routes),
+            "novofon_to_bot": sum(r.novofon_to_bot for r in self.routes.values()),
+            "mts_mirror": sum(r.mirror_to_novofon for r in self.routes.values()),
+            "mts_primary": sum(r.wb_primary for r in self.routes.values()),
+            "forwards": sum(r.forward_to is not None for r in self.routes.values()),
+        }
+
+
+def compile_table(data: dict, source: str = "default", mtime: float = None) -> RoutingTable:
+    """Сборка таблицы из словаря формата DEFAULT_ROUTING. Ошибки формата — ValueError."""
+
+    if not isinstance(data, dict):
+        raise ValueError("routing: ожидается JSON-объект")
+
+    flags: dict[str, dict] = {}
+
+    def mark(phones, name: str, value):
+        for phone in phones:
+            key = normalize_phone(str(phone))
+            if len(key) != 10:
+                raise ValueError(f"routing: некорректный номер {phone!r} в {name}")
+            flags.setdefault(key, {})[name] = value
+
+    for name, attr in (("novofon_to_bot", "novofon_to_bot"),
+                       ("mts_mirror", "mirror_to_novofon"),
+                       ("mts_primary", "wb_primary")):
+        phones = data.get(name, [])
+        if not isinstance(phones, list):
+            raise ValueError(f"routing: {name} должен быть списком номеров")
+        mark(phones, attr, True)
+
+    forwards = data.get("forwards", {})
+    if not isinstance(forwards, dict):
+        raise ValueError("routing: forwards должен быть объектом номер -> Telegram ID")
+    for phone, tg_id in forwards.items():
+        mark([phone], "forward_to", str(tg_id))
+
+    routes = {phone: Route(**values) for phone, values in flags.items()}
+    return RoutingTable(routes=MappingProxyType(routes), source=source, mtime=mtime)
+
+
+def load_table() -> RoutingTable:
+    """Загрузка таблицы из ROUTING_FILE (или значений по умолчанию, если файл не задан)"""
+
+    if not ROUTING_FILE or not os.path.exists(ROUTING_FILE):
+        return compile_table(DEFAULT_ROUTING)
+
+    mtime = os.path.getmtime(ROUTING_FILE)
+    with open(ROUTING_FILE, encoding="utf-8") as file:
+        data = json.load(file)
+    return compile_table(data, source=ROUTING_FILE, mtime=mtime)
+
+
+# При импорте — значения по умолчанию; файл читается в reload() из lifespan, ошибка в нём не мешает импорту
+_table: RoutingTable = compile_table(DEFAULT_ROUTING)
+_reload_lock = threading.RLock()
+_watcher: asyncio.Task | None = None
+
+
+def reload() -> RoutingTable:
+    """
+    Перечитывание таблицы и атомарная подмена ссылки на неё.
+
+    При ошибке в файле остаётся прежняя таблица, ошибка пробрасывается вызывающему.
+    """
+
+    global _table
+    with _reload_lock:
+        table = load_table()
+        _table = table  # обработчики, уже получившие старую таблицу, дорабатывают с ней
+    print(f"routing: загружено {len(table.routes)} номеров из {table.source}")
+    return table
+
+
+def check_file() -> None:
+    """Перечитывание таблицы, если mtime ROUTING_FILE изменился. Работает с диском — вызывается вне event loop."""
+
+    try:
+        mtime = os.path.getmtime(ROUTING_FILE) if os.path.exists(ROUTING_FILE) else None
+        if mtime != _table.mtime:
+            reload()
+    except (OSError, ValueError) as e:
+        print(f"⚠️ routing: ошибка перечитывания {ROUTING_FILE}, остаётся прежняя таблица: {e}")
+
+
+def get_table() -> RoutingTable:
+    """Текущая таблица (только чтение ссылки, без обращения к диску)"""
+
+    return _table
+
+
+def lookup(phone: str) -> Route:
+    return get_table().lookup(phone)
+
+
+def _reload_logged() -> None:
+    try:
+        reload()
+    except (OSError, ValueError) as e:
+        print(f"⚠️ routing: ошибка перечитывания по сигналу, остаётся прежняя таблица: {e}")
+
+
+async def _watch() -> None:
+    while True:
+        await asyncio.sleep(ROUTING_CHECK_INTERVAL)
+        await run_in_threadpool(check_file)
+
+
+def start(signum: int = signal.SIGHUP) -> None:
+    """
+    Фоновое перечитывание таблицы в текущем воркере: по изменению mtime файла и по сигналу (SIGHUP).
+
+    Сигнал обрабатывается через event loop (add_signal_handler), а само перечитывание идёт
+    в пуле потоков: обработчик не прерывает код, держащий блокировку таблицы, и не читает файл в loop.
+    """
+
+    global _watcher
+    loop = asyncio.get_running_loop()
+
+    try:
+        loop.add_signal_handler(signum, lambda: asyncio.ensure_future(run_in_threadpool(_reload_logged)))
+    except (ValueError, RuntimeError, NotImplementedError):
+        # Не главный поток (например, тестовый клиент) — остаются перечитывание по mtime и через эндпоинт
+        print("⚠️ routing: обработчик сигнала не установлен (не главный поток)")
+
+    if ROUTING_FILE and _watcher is None:
+        _watcher = asyncio.create_task(_watch())
+
+
+async def stop(signum: int = signal.SIGHUP) -> None:
+    global _watcher
+
+    try:
+        asyncio.get_running_loop().remove_signal_handler(signum)
+    except (ValueError, RuntimeError, NotImplementedError):
+        pass
+    if _watcher is not None:
+        _watcher.cancel()
+        try:
+            await _watcher
+        except asyncio.CancelledError:
+            pass
+        _watcher = None
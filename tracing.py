@@ -0,0 +1,248 @@
+import json
+import time
+import uuid
+import httpx
+import asyncio
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+
+from fastapi.concurrency import run_in_threadpool
+
+import config
+from resources import resources
+
+# Куда выгружать трейсы: локальный JSONL-файл и/или OTLP/HTTP-коллектор (JSON-кодировка)
+TRACE_FILE = getattr(config, "TRACE_FILE", None)
+TRACE_OTLP_URL = getattr(config, "TRACE_OTLP_URL", None)  # например http://127.0.0.1:4318/v1/traces
+TRACE_SERVICE_NAME = getattr(config, "TRACE_SERVICE_NAME", "api_phone")
+
+# Сколько последних значений time-to-match хранить на пару (площадка, номер) для перцентилей
+TRACE_STATS_SAMPLES = 500
+
+_file_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_stats: dict[tuple[str, str], dict] = {}
+_exports: set[asyncio.Task] = set()
+
+
+class Trace:
+    """
+    Трейс одного входящего сообщения: от прихода вебхука до сопоставления кода в phone_message.
+
+    Все спаны трейса имеют общий trace_id (correlation id), по которому этапы
+    (вебхук, коррекция времени, рассылка в Telegram, add_message) склеиваются в отчётах и коллекторе.
+    """
+
+    def __init__(self, source: str, phone: str = None, marketplace: str | list[str] = None):
+        self.trace_id = uuid.uuid4().hex
+        self.source = source  # novofon_sms / novofon_call / mts
+        self.phone = phone
+        self.marketplace = marketplace  # площадка или площадки-кандидаты (звонок: Ozon/Yandex) до сопоставления
+        self.attributes: dict = {}
+        self.spans: list[dict] = []
+        self.matched: bool | None = None
+        self.match_ms: float | None = None  # время до сопоставления кода; этапы после него не учитываются
+        self.started_ns = time.time_ns()
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Замер одного этапа обработки. Исключение внутри этапа помечается в спане и пробрасывается дальше."""
+
+        span = {"span_id": uuid.uuid4().hex[:16], "name": name, "start_ns": time.time_ns(),
+                "attributes": dict(attributes), "error": None}
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span["error"] = repr(e)
+            raise
+        finally:
+            span["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            span["end_ns"] = span["start_ns"] + int(span["duration_ms"] * 1_000_000)
+            self.spans.append(span)
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self._started) * 1000, 3)
+
+    def mark_match(self) -> None:
+        """Фиксация момента сопоставления кода: от него считается time-to-match в отчёте"""
+
+        self.match_ms = self.elapsed_ms()
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "source": self.source,
+            "phone": self.phone,
+            "marketplace": self.marketplace,
+            "matched": self.matched,
+            "total_ms": self.elapsed_ms(),
+            "match_ms": self.match_ms,
+            "start_ns": self.started_ns,
+            "attributes": self.attributes,
+            "spans": self.spans,
+        }
+
+    async def finish(self, matched: bool | None = None) -> None:
+        """
+        Завершение трейса: учёт в агрегатах и выгрузка в фоне (вебхук не ждёт файл и коллектор).
+
+        matched: True — код сопоставлен с запросом, False — запрос не найден,
+        None — сопоставление не выполнялось (например, сообщение без кода).
+        """
+
+        self.matched = matched
+        data = self.to_dict()
+        _account(data)
+
+        if TRACE_FILE or TRACE_OTLP_URL:
+            task = asyncio.create_task(_export(data))
+            _exports.add(task)
+            task.add_done_callback(_exports.discard)
+
+
+async def _export(data: dict) -> None:
+    if TRACE_FILE:
+        try:
+            await run_in_threadpool(_write_file, data)
+        except OSError as e:
+            print(f"⚠️ Ошибка записи трейса: {e}")
+
+    if TRACE_OTLP_URL and resources.http is not None:
+        try:
+            await resources.http.post(TRACE_OTLP_URL, json=_to_otlp(data), timeout=5.0)
+        except httpx.RequestError as e:
+            print(f"⚠️ Ошибка отправки трейса в коллектор: {e}")
+
+
+async def flush() -> None:
+    """Ожидание выгрузки завершённых трейсов (при остановке, до закрытия HTTP-клиентов)"""
+
+    if _exports:
+        await asyncio.gather(*_exports, return_exceptions=True)
+
+
+def _write_file(data: dict) -> None:
+    line = json.dumps(data, ensure_ascii=False, default=str)
+    with _file_lock:
+        with open(TRACE_FILE, "a", encoding="utf-8") as file:
+            file.write(line + "\n")
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, (list, tuple)):
+        return {"stringValue": "/".join(map(str, value))}
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attrs(attributes: dict) -> list[dict]:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items() if v is not None]
+
+
+def _to_otlp(data: dict) -> dict:
+    """Трейс в формате OTLP/HTTP JSON: корневой спан сообщения и дочерние спаны этапов."""
+
+    root_id = uuid.uuid4().hex[:16]
+    root_attrs = {"source": data["source"], "phone": data["phone"],
+                  "marketplace": data["marketplace"], "matched": data["matched"], **data["attributes"]}
+    spans = [{
+        "traceId": data["trace_id"],
+        "spanId": root_id,
+        "name": f"otp.{data['source']}",
+        "kind": 2,  # SERVER
+        "startTimeUnixNano": str(data["start_ns"]),
+        "endTimeUnixNano": str(data["start_ns"] + int(data["total_ms"] * 1_000_000)),
+        "attributes": _otlp_attrs(root_attrs),
+    }]
+    for span in data["spans"]:
+        spans.append({
+            "traceId": data["trace_id"],
+            "spanId": span["span_id"],
+            "parentSpanId": root_id,
+            "name": span["name"],
+            "kind": 1,  # INTERNAL
+            "startTimeUnixNano": str(span["start_ns"]),
+            "endTimeUnixNano": str(span["end_ns"]),
+            "attributes": _otlp_attrs(span["attributes"]),
+            "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 1},
+        })
+    return {"resourceSpans": [{
+        "resource": {"attributes": _otlp_attrs({"service.name": TRACE_SERVICE_NAME})},
+        "scopeSpans": [{"scope": {"name": "api_phone.tracing"}, "spans": spans}],
+    }]}
+
+
+def _account(data: dict) -> None:
+    """
+    Учёт трейса в агрегатах по паре (площадка, номер). Трейсы без попытки сопоставления не учитываются.
+    Несопоставленный трейс с несколькими площадками-кандидатами учитывается в каждой из них.
+    """
+
+    if data["matched"] is None:
+        return
+
+    marketplaces = data["marketplace"] if isinstance(data["marketplace"], (list, tuple)) else [data["marketplace"]]
+    with _stats_lock:
+        for marketplace in marketplaces or [None]:
+            key = (marketplace or "unknown", data["phone"] or "unknown")
+            stats = _stats.setdefault(key, {"matched": 0, "failed": 0,
+                                            "samples": deque(maxlen=TRACE_STATS_SAMPLES)})
+            if data["matched"]:
+                stats["matched"] += 1
+                stats["samples"].append(data["match_ms"] if data.get("match_ms") is not None else data["total_ms"])
+            else:
+                stats["failed"] += 1
+
+
+def _percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def report() -> dict:
+    """Агрегированный отчёт: time-to-match (мс) и число несопоставленных кодов по площадкам и номерам."""
+
+    with _stats_lock:
+        snapshot = {key: (s["matched"], s["failed"], list(s["samples"])) for key, s in _stats.items()}
+
+    by_marketplace: dict[str, dict] = {}
+    by_number = []
+    for (marketplace, phone), (matched, failed, samples) in sorted(snapshot.items()):
+        by_number.append({
+            "marketplace": marketplace,
+            "phone": phone,
+            "matched": matched,
+            "failed": failed,
+            "p50_ms": _percentile(samples, 0.5),
+            "p95_ms": _percentile(samples, 0.95),
+            "max_ms": max(samples) if samples else None,
+        })
+        agg = by_marketplace.setdefault(marketplace, {"matched": 0, "failed": 0, "samples": []})
+        agg["matched"] += matched
+        agg["failed"] += failed
+        agg["samples"].extend(samples)
+
+    return {
+        "by_marketplace": {
+            marketplace: {
+                "matched": agg["matched"],
+                "failed": agg["failed"],
+                "p50_ms": _percentile(agg["samples"], 0.5),
+                "p95_ms": _percentile(agg["samples"], 0.95),
+                "max_ms": max(agg["samples"]) if agg["samples"] else None,
+            }
+            for marketplace, agg in by_marketplace.items()
+        },
+        "by_number": by_number,
+    }